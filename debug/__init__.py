@@ -1,2 +1,5 @@
 from .simpledebug import SimpleDebug
 from .debug import Debug
+from .sinks import StreamSink, RingBufferSink, ThreadedSink, LogFileSink
+from .flightrecorder import FlightRecorder
+from .timing import DebugTimer, Histogram, Timing
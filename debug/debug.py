@@ -9,6 +9,14 @@ This module handles debug logging.
 
 """
 
+import signal
+import sys
+import threading
+import time
+
+from .flightrecorder import FlightRecorder
+from .sinks import StreamSink
+
 
 class Debug:
     """Helper class for debug logging. """
@@ -31,48 +39,185 @@ class Debug:
     }
     """(*dict*) Container for all debug messages."""
 
+    SINK = StreamSink()
+    """(*object*) Sink debug messages are written to, see debug.sinks."""
+
+    FLIGHT_RECORDER = None
+    """(*FlightRecorder*) Records debug events when set."""
+
+    __indexed_groups = None
+    """(*list*) The ACTIVE_DEBUG_GROUPS list the debug index was built from."""
+
+    __active_group_set = frozenset()
+    """(*frozenset*) Active debug groups."""
+
+    __enabled_ids = {}
+    """(*dict*) Cached status of debug ids."""
+
+    @staticmethod
+    def set_active_debug_groups(groups):
+        """
+        Set active debug groups.
+
+        :param list groups: Debug groups to activate.
+
+        """
+        Debug.ACTIVE_DEBUG_GROUPS = list(groups)
+        Debug.invalidate_debug_index()
+
+    @staticmethod
+    def invalidate_debug_index():
+        """
+        Rebuild the debug index on next status check.
+
+        Must be called after ACTIVE_DEBUG_GROUPS or DEBUG_DATA is modified in
+        place. Assigning a new list to ACTIVE_DEBUG_GROUPS is detected
+        automatically.
+
+        """
+        Debug.__indexed_groups = None
+
     # noinspection PyShadowingBuiltins
     @staticmethod
     def debug_status(id):
         """
         Get the current status for a specified debug id.
 
+        The status of each id is cached, so a disabled debug point costs an
+        identity check and a dict lookup, see invalidate_debug_index.
+
         :param any id: Target status debug id.
         :rtype:   bool
         :returns: Current status if the debug id.
 
         """
-        id_groups = Debug.DEBUG_DATA[id]['groups']
-        current_groups = [
-            i for i in id_groups if i in Debug.ACTIVE_DEBUG_GROUPS]
-        if len(current_groups) >= 1 or 'all' in Debug.ACTIVE_DEBUG_GROUPS:
-            return True
-        return False
+        if Debug.ACTIVE_DEBUG_GROUPS is not Debug.__indexed_groups:
+            Debug.__indexed_groups = Debug.ACTIVE_DEBUG_GROUPS
+            Debug.__active_group_set = frozenset(Debug.ACTIVE_DEBUG_GROUPS)
+            Debug.__enabled_ids = {}
+        try:
+            return Debug.__enabled_ids[id]
+        except KeyError:
+            status = ('all' in Debug.__active_group_set or
+                      not Debug.__active_group_set.isdisjoint(
+                          Debug.DEBUG_DATA[id]['groups']))
+            Debug.__enabled_ids[id] = status
+            return status
+
+    @staticmethod
+    def start_flight_recorder(size=4096, record_disabled=False):
+        """
+        Start recording debug events in memory.
+
+        :param int size:             Number of events to keep.
+        :param bool record_disabled: If events for inactive debug ids should
+                                     be recorded.
+
+        """
+        Debug.FLIGHT_RECORDER = FlightRecorder(size, record_disabled)
+
+    @staticmethod
+    def stop_flight_recorder():
+        """
+        Stop recording debug events.
+
+        """
+        Debug.FLIGHT_RECORDER = None
+
+    # noinspection PyShadowingBuiltins
+    @staticmethod
+    def dump_flight_recorder(sink=None):
+        """
+        Write recorded debug events to a sink and clear them.
+
+        Messages are formatted from DEBUG_DATA now, so deferred arguments are
+        evaluated at dump time.
+
+        :param sink: Sink to write to, if None Debug.SINK is used.
+
+        """
+        recorder = Debug.FLIGHT_RECORDER
+        if recorder is None:
+            return
+        events = recorder.events()
+        recorder.clear()
+        now = time.monotonic()
+        lines = ["Flight recorder: {} events".format(len(events))]
+        for id, args, timestamp in events:
+            try:
+                if callable(args):
+                    args = args()
+                message = Debug.DEBUG_DATA[id]['message'].format(*args)
+            except Exception as error:
+                message = "{} {!r} ({!r})".format(id, args, error)
+            lines.append("{:.6f}s {}".format(timestamp - now, message))
+        sink = Debug.SINK if sink is None else sink
+        sink.write(lines, Debug.__LEVEL_COLOR[1])
+        sink.flush()
+
+    @staticmethod
+    def dump_flight_recorder_on_signal(signum=signal.SIGUSR1):
+        """
+        Dump the flight recorder when a signal is received.
+
+        The dump is written from a new thread, since the signal can arrive
+        while the main thread holds the lock of the sink.
+
+        :param int signum: Signal number.
+
+        """
+        def dump(*_):
+            threading.Thread(target=Debug.dump_flight_recorder,
+                             daemon=True).start()
+
+        signal.signal(signum, dump)
+
+    @staticmethod
+    def dump_flight_recorder_on_exception():
+        """
+        Dump the flight recorder when an exception is not handled.
+
+        """
+        excepthook = sys.excepthook
+
+        def dump_and_raise(*args):
+            Debug.dump_flight_recorder()
+            excepthook(*args)
+
+        sys.excepthook = dump_and_raise
 
     # noinspection PyShadowingBuiltins
     def debug_print(self, id, args=list()):
         """
         Print debug message.
 
+        Nothing is evaluated unless the debug id is active. Expensive
+        arguments can be deferred by passing a function that returns the
+        argument list, for example::
+
+            debug.debug_print('test1', lambda: [repr(big_object)])
+
         :param any id:           Id of the debug message.
-        :param list args:        Arguments for the debug message.
+        :param args:             Arguments for the debug message, a list or
+                                 a function returning a list.
 
         """
-        if not isinstance(args, list):
-            raise DebugArgumentTypeError(arg_name='args',
-                                         arg_value=args,
-                                         arg_type='list')
-        if Debug.debug_status(id):
+        status = Debug.debug_status(id)
+        recorder = Debug.FLIGHT_RECORDER
+        if recorder is not None and (status or recorder.record_disabled):
+            recorder.record(id, args)
+        if status:
+            if callable(args):
+                args = args()
+            if not isinstance(args, list):
+                raise DebugArgumentTypeError(arg_name='args',
+                                             arg_value=args,
+                                             arg_type='list')
             color = 1
             if 'color' in self.DEBUG_DATA[id]:
                 color = self.DEBUG_DATA[id]['color']
-            start = self.__LEVEL_COLOR[color]
-            end = "\033[0m"
             message = (self.DEBUG_DATA[id]['message']).format(*args)
-            message = "{}{}{}".format(start, message, end)
-            print()
-            print(message)
-            print()
+            self.SINK.write([message], self.__LEVEL_COLOR[color])
 
 
 class DebugError(Exception):
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Flight recorder
+***************
+
+This module records debug events in a fixed size ring buffer.
+
+"""
+
+import itertools
+import time
+
+
+class FlightRecorder:
+    """
+    Fixed size ring buffer of debug events.
+
+    An event is a debug id, its raw arguments and a monotonic timestamp.
+    Nothing is formatted when an event is recorded, the oldest events are
+    overwritten when the buffer is full.
+
+    """
+
+    def __init__(self, size=4096, record_disabled=False):
+        """
+        Initializes a FlightRecorder instance.
+
+        :param int size:             Number of events to keep.
+        :param bool record_disabled: If events for inactive debug ids should
+                                     be recorded.
+
+        """
+        self.size = size
+        self.record_disabled = record_disabled
+        self._ids = [None] * size
+        self._args = [None] * size
+        self._times = [0.0] * size
+        self._counter = itertools.count()
+        self._recorded = 0
+
+    # noinspection PyShadowingBuiltins
+    def record(self, id, args):
+        """
+        Record a debug event.
+
+        :param any id:   Id of the debug message.
+        :param args:     Arguments for the debug message.
+
+        """
+        i = next(self._counter)
+        slot = i % self.size
+        self._ids[slot] = id
+        self._args[slot] = args
+        self._times[slot] = time.monotonic()
+        self._recorded = i + 1
+
+    def events(self):
+        """
+        Get recorded events, oldest first.
+
+        :rtype:   list
+        :returns: Tuples of debug id, arguments and monotonic timestamp.
+
+        """
+        recorded = self._recorded
+        first = max(0, recorded - self.size)
+        slots = [i % self.size for i in range(first, recorded)]
+        return [(self._ids[i], self._args[i], self._times[i]) for i in slots]
+
+    def clear(self):
+        """
+        Remove all recorded events.
+
+        """
+        self._ids = [None] * self.size
+        self._args = [None] * self.size
+        self._times = [0.0] * self.size
+        self._counter = itertools.count()
+        self._recorded = 0
@@ -9,6 +9,8 @@ This module prints debug messages to screen.
 
 """
 
+from .sinks import StreamSink
+
 
 class SimpleDebug:
     """
@@ -26,29 +28,37 @@ class SimpleDebug:
         10: "\033[0;30;43m"}
     """(*dict*) Debug level color."""
 
+    SINK = StreamSink()
+    """(*object*) Sink debug messages are written to, see debug.sinks."""
+
     # noinspection PyShadowingBuiltins
     def debug_print(self, level, message, module=None, class_=None,
                     function=None):
         """
         Print debug message to screen.
 
+        The message is only built if the debug level is active when it is
+        passed as a function that returns the message, for example::
+
+            debug.debug_print(3, lambda: 'State: {}'.format(repr(state)))
+
         :param int level:    Lowest debug level message will be printed in.
-        :param str message:  Message to print.
+        :param message:      Message to print, a str or a function returning
+                             a str.
         :param str module:   Module this debug printout is used in.
         :param str class_:   Class this debug printout is used in.
         :param str function: Function this debug printout is used in.
 
         """
         if self.DEBUG_LEVEL >= level:
-            start = SimpleDebug.__LEVEL_COLOR[level]
-            end = "\033[0m"
-            print()
-            print("{}Debug level: {}{}".format(start, level, end))
+            if callable(message):
+                message = message()
+            lines = ["Debug level: {}".format(level)]
             if module is not None:
-                print("{}Module: {}{}".format(start, module, end))
+                lines.append("Module: {}".format(module))
             if class_ is not None:
-                print("{}Class: {}{}".format(start, class_, end))
+                lines.append("Class: {}".format(class_))
             if function is not None:
-                print("{}Function: {}{}".format(start, function, end))
-            print("{}{}{}".format(start, message, end))
-            print()
+                lines.append("Function: {}".format(function))
+            lines.append("{}".format(message))
+            self.SINK.write(lines, SimpleDebug.__LEVEL_COLOR[level])
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Debug sinks
+***********
+
+This module contains the outputs debug messages can be written to.
+
+A sink receives each debug message as a list of lines together with the ANSI
+color code of the message, and writes the whole message in one operation.
+
+"""
+
+import atexit
+import collections
+import queue
+import sys
+import threading
+
+
+class StreamSink:
+    """Writes debug messages to a stream, stdout by default."""
+
+    __END_COLOR = "\033[0m"
+    """(*str*) ANSI code that ends a color."""
+
+    def __init__(self, stream=None, color=None, buffer_size=0):
+        """
+        Initializes a StreamSink instance.
+
+        :param stream:          File like object to write to. If None the
+                                current sys.stdout is used.
+        :param bool color:      If ANSI colors should be written. If None
+                                colors are only written if the stream is a
+                                TTY.
+        :param int buffer_size: Number of characters to collect before they
+                                are written to the stream. If set to 0 every
+                                message is written directly.
+
+        """
+        self._stream = stream
+        self._color = color
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        self._lock = threading.Lock()
+        if self._buffer_size > 0:
+            atexit.register(self.flush)
+
+    def write(self, lines, color):
+        """
+        Write a debug message.
+
+        :param list lines: Lines of the message.
+        :param str color:  ANSI color code of the message.
+
+        """
+        stream = self._get_stream()
+        if self._color or (self._color is None and self._isatty(stream)):
+            lines = [color + i + StreamSink.__END_COLOR for i in lines]
+        text = '\n' + '\n'.join(lines) + '\n\n'
+        with self._lock:
+            if self._buffer_size <= 0:
+                stream.write(text)
+                return
+            self._buffer.append(text)
+            self._buffered += len(text)
+            if self._buffered >= self._buffer_size:
+                self._flush(stream)
+
+    def flush(self):
+        """
+        Write buffered debug messages and flush the stream.
+
+        """
+        stream = self._get_stream()
+        with self._lock:
+            self._flush(stream)
+            stream.flush()
+
+    def _flush(self, stream):
+        """
+        Write buffered debug messages to the stream.
+
+        :param stream: File like object to write to.
+
+        """
+        if self._buffered > 0:
+            stream.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def _get_stream(self):
+        """
+        Get the stream to write to.
+
+        """
+        return sys.stdout if self._stream is None else self._stream
+
+    @staticmethod
+    def _isatty(stream):
+        """
+        Check if a stream is a TTY.
+
+        :param stream: File like object.
+        :rtype: bool
+
+        """
+        try:
+            return stream.isatty()
+        except (AttributeError, ValueError):
+            return False
+
+
+class RingBufferSink:
+    """Keeps the latest debug messages in memory."""
+
+    def __init__(self, size=1000):
+        """
+        Initializes a RingBufferSink instance.
+
+        :param int size: Max number of debug messages to keep.
+
+        """
+        self._messages = collections.deque(maxlen=size)
+
+    def write(self, lines, color):
+        """
+        Store a debug message, older messages are dropped when full.
+
+        :param list lines: Lines of the message.
+        :param str color:  ANSI color code of the message.
+
+        """
+        self._messages.append((lines, color))
+
+    def flush(self):
+        """
+        Nothing to flush, messages are kept in memory.
+
+        """
+
+    def messages(self):
+        """
+        Get stored debug messages, oldest first.
+
+        :rtype:   list
+        :returns: Messages as lists of lines.
+
+        """
+        return [i[0] for i in list(self._messages)]
+
+    def dump(self, sink):
+        """
+        Write stored debug messages to another sink and clear them.
+
+        :param sink: Sink to write the messages to.
+
+        """
+        while len(self._messages) > 0:
+            sink.write(*self._messages.popleft())
+        sink.flush()
+
+
+class ThreadedSink:
+    """Writes debug messages to another sink from a background thread."""
+
+    __STOP = object()
+    """(*object*) Queue item that stops the writer thread."""
+
+    def __init__(self, sink, queue_size=10000):
+        """
+        Initializes a ThreadedSink instance.
+
+        :param sink:           Sink the background thread writes to.
+        :param int queue_size: Max number of debug messages waiting to be
+                               written, messages are dropped when full.
+
+        """
+        self._sink = sink
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, lines, color):
+        """
+        Queue a debug message without blocking.
+
+        :param list lines: Lines of the message.
+        :param str color:  ANSI color code of the message.
+
+        """
+        try:
+            self._queue.put_nowait((lines, color))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """
+        Wait until all queued debug messages have been written.
+
+        """
+        self._queue.join()
+        self._sink.flush()
+
+    def close(self):
+        """
+        Write queued debug messages and stop the background thread.
+
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(ThreadedSink.__STOP)
+        self._thread.join()
+        self._sink.flush()
+
+    def _writer(self):
+        """
+        Writer thread, drains the queue to the sink.
+
+        """
+        while True:
+            item = self._queue.get()
+            try:
+                if item is ThreadedSink.__STOP:
+                    return
+                self._sink.write(*item)
+                if self._queue.empty():
+                    self._sink.flush()
+            finally:
+                self._queue.task_done()
+
+
+class LogFileSink:
+    """Writes debug messages to a log file."""
+
+    def __init__(self, log_file, level=0):
+        """
+        Initializes a LogFileSink instance.
+
+        :param log_file:  A logfile.LogFile instance, or any object with the
+                          same write method.
+        :param int level: Verbosity level to write messages with.
+
+        """
+        self._log_file = log_file
+        self._level = level
+
+    def write(self, lines, color):
+        """
+        Write a debug message to the log file.
+
+        :param list lines: Lines of the message.
+        :param str color:  ANSI color code of the message, not used.
+
+        """
+        self._log_file.write(lines, self._level)
+
+    def flush(self):
+        """
+        Flush the log file if it supports it.
+
+        """
+        if hasattr(self._log_file, 'flush'):
+            self._log_file.flush()
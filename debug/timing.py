@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Timing
+******
+
+This module measures execution time of code paths.
+
+Timers use the same ids as Debug.DEBUG_DATA and are only active when the id
+is active in Debug.ACTIVE_DEBUG_GROUPS. Example::
+
+    with DebugTimer.timer('handle_request'):
+        handle_request()
+
+    @DebugTimer.timed('handle_request')
+    def handle_request():
+        ...
+
+"""
+
+import functools
+import json
+import threading
+import time
+
+from .debug import Debug
+
+
+class Histogram:
+    """
+    Histogram of durations in nanoseconds.
+
+    Values are counted in log-linear buckets with 16 buckets per power of two,
+    so percentiles are accurate to about 6% and recording is a few integer
+    operations and a dict update under a lock.
+
+    """
+
+    __PRECISION_BITS = 5
+    """(*int*) Number of significant bits kept for each value."""
+
+    def __init__(self):
+        """
+        Initializes a Histogram instance.
+
+        """
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        """
+        Record a value.
+
+        :param int value: Duration in nanoseconds.
+
+        """
+        shift = max(value.bit_length() - Histogram.__PRECISION_BITS, 0)
+        bucket = (shift << Histogram.__PRECISION_BITS) | (value >> shift)
+        with self._lock:
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, percent):
+        """
+        Get a percentile.
+
+        :param float percent: Percentile to get, 0 to 100.
+        :rtype:   int
+        :returns: Upper bound of the percentile in nanoseconds.
+
+        """
+        with self._lock:
+            count = self.count
+            maximum = self.max
+            buckets = sorted(self._buckets.items())
+        if count == 0:
+            return 0
+        rank = count * percent / 100
+        seen = 0
+        mask = (1 << Histogram.__PRECISION_BITS) - 1
+        for bucket, bucket_count in buckets:
+            seen += bucket_count
+            if seen >= rank:
+                shift = bucket >> Histogram.__PRECISION_BITS
+                upper = (((bucket & mask) + 1) << shift) - 1
+                return min(upper, maximum)
+        return maximum
+
+    def summary(self):
+        """
+        Get a summary of the histogram.
+
+        :rtype:   dict
+        :returns: Count, mean, p50, p99 and max in milliseconds.
+
+        """
+        with self._lock:
+            count = self.count
+            total = self.total
+            maximum = self.max
+        mean = total / count if count > 0 else 0
+        return {'count': count,
+                'mean_ms': mean / 1e6,
+                'p50_ms': self.percentile(50) / 1e6,
+                'p99_ms': self.percentile(99) / 1e6,
+                'max_ms': maximum / 1e6}
+
+
+class Timing:
+    """Context manager that times a block of code for a debug id."""
+
+    __slots__ = ('_id', '_start')
+
+    # noinspection PyShadowingBuiltins
+    def __init__(self, id):
+        """
+        Initializes a Timing instance.
+
+        :param any id: Debug id to record the time for.
+
+        """
+        self._id = id
+        self._start = None
+
+    def __enter__(self):
+        """
+        Start timing if the debug id is active.
+
+        """
+        if Debug.debug_status(self._id):
+            self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Stop timing and record the duration.
+
+        """
+        if self._start is not None:
+            DebugTimer.record(self._id, time.perf_counter_ns() - self._start)
+            self._start = None
+
+
+class DebugTimer:
+    """Collects execution time histograms per debug id."""
+
+    HISTOGRAMS = {}
+    """(*dict*) Histogram for each debug id."""
+
+    # noinspection PyShadowingBuiltins
+    @staticmethod
+    def timer(id):
+        """
+        Get a context manager that times a block of code.
+
+        :param any id: Debug id to record the time for.
+        :rtype: Timing
+
+        """
+        return Timing(id)
+
+    # noinspection PyShadowingBuiltins
+    @staticmethod
+    def timed(id):
+        """
+        Decorator that times calls to a function.
+
+        :param any id: Debug id to record the time for.
+        :rtype: function
+
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not Debug.debug_status(id):
+                    return function(*args, **kwargs)
+                start = time.perf_counter_ns()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    DebugTimer.record(id, time.perf_counter_ns() - start)
+            return wrapper
+        return decorator
+
+    # noinspection PyShadowingBuiltins
+    @staticmethod
+    def record(id, duration):
+        """
+        Record a duration for a debug id.
+
+        :param any id:       Debug id.
+        :param int duration: Duration in nanoseconds.
+
+        """
+        histogram = DebugTimer.HISTOGRAMS.get(id)
+        if histogram is None:
+            histogram = DebugTimer.HISTOGRAMS.setdefault(id, Histogram())
+        histogram.record(duration)
+
+    @staticmethod
+    def reset():
+        """
+        Remove all recorded durations.
+
+        """
+        DebugTimer.HISTOGRAMS = {}
+
+    @staticmethod
+    def summary():
+        """
+        Get a summary of all histograms.
+
+        :rtype:   dict
+        :returns: Histogram summary for each debug id.
+
+        """
+        return {str(id): histogram.summary()
+                for id, histogram in list(DebugTimer.HISTOGRAMS.items())}
+
+    @staticmethod
+    def report_json():
+        """
+        Get a summary of all histograms as JSON.
+
+        :rtype: str
+
+        """
+        return json.dumps(DebugTimer.summary(), sort_keys=True)
+
+    @staticmethod
+    def report_text():
+        """
+        Get a summary of all histograms as a text table.
+
+        :rtype: str
+
+        """
+        lines = ["{:<30} {:>10} {:>10} {:>10} {:>10}".format(
+            'id', 'count', 'p50 ms', 'p99 ms', 'max ms')]
+        for id, summary in sorted(DebugTimer.summary().items()):
+            lines.append("{:<30} {:>10} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                id, summary['count'], summary['p50_ms'], summary['p99_ms'],
+                summary['max_ms']))
+        return '\n'.join(lines)
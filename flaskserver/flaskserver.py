@@ -12,9 +12,251 @@ This modules is a template flask web server.
 
 # Built in modules
 import argparse
+import asyncio
+import atexit
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import email.utils
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 
 # Third party modules
-from flask import Flask, render_template, request
+from flask import (Flask, Response, abort, render_template, request,
+                   send_file, stream_with_context)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class StreamingBodyParser:
+    """
+    Incremental parsers for request bodies.
+
+    The body is read from request.stream in chunks, so the raw body is never
+    held in memory as a whole. Requests larger than MAX_CONTENT_LENGTH are
+    rejected with 413, before the body is read if Content-Length is set.
+
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    """(*int*) Number of bytes read from the request stream at a time."""
+
+    @staticmethod
+    def iter_form(stream):
+        """
+        Parse an URL encoded form.
+
+        :param stream: Request body stream.
+        :rtype:  generator
+        :return: Field names and values.
+
+        """
+        pending = b''
+        for chunk in StreamingBodyParser._chunks(stream):
+            fields = (pending + chunk).split(b'&')
+            pending = fields.pop()
+            for field in fields:
+                yield from urllib.parse.parse_qsl(
+                    field.decode('utf-8', 'replace'), keep_blank_values=True)
+        if len(pending) > 0:
+            yield from urllib.parse.parse_qsl(
+                pending.decode('utf-8', 'replace'), keep_blank_values=True)
+
+    @staticmethod
+    def iter_json(stream):
+        """
+        Parse a JSON document.
+
+        A top level object is parsed one member at a time, so only the
+        member being parsed is buffered. Other documents are parsed whole.
+
+        :param stream: Request body stream.
+        :rtype:  generator
+        :return: Member names and values of a top level object, or a single
+                 None name and the document.
+
+        """
+        reader = _JsonStreamReader(StreamingBodyParser._chunks(stream))
+        if not reader.startswith('{'):
+            yield None, reader.decode_rest()
+            return
+        reader.expect('{')
+        if reader.startswith('}'):
+            reader.expect('}')
+        else:
+            while True:
+                name = reader.decode_value()
+                if not isinstance(name, str):
+                    abort(400)
+                reader.expect(':')
+                yield name, reader.decode_value()
+                if reader.startswith(','):
+                    reader.expect(',')
+                    continue
+                reader.expect('}')
+                break
+        reader.expect_end()
+
+    @staticmethod
+    def _chunks(stream):
+        """
+        Read a request body stream in chunks, limited to MAX_CONTENT_LENGTH.
+
+        :param stream: Request body stream.
+        :rtype:  generator
+        :return: Chunks of the body.
+
+        """
+        max_size = web_server.config.get('MAX_CONTENT_LENGTH')
+        if (max_size is not None and request.content_length is not None and
+                request.content_length > max_size):
+            abort(413)
+        size = 0
+        while True:
+            chunk = stream.read(StreamingBodyParser.CHUNK_SIZE)
+            if len(chunk) == 0:
+                return
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                abort(413)
+            yield chunk
+
+
+class _JsonStreamReader:
+    """Buffer of JSON text that is filled from chunks when needed."""
+
+    def __init__(self, chunks):
+        """
+        Initializes a _JsonStreamReader instance.
+
+        :param chunks: Iterator of UTF-8 encoded chunks.
+
+        """
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._offset = 0
+        self._eof = False
+
+    def startswith(self, text):
+        """
+        Check the next non-whitespace text.
+
+        :param str text: Text to compare with.
+        :rtype: bool
+
+        """
+        self._skip_whitespace()
+        return self._buffer.startswith(text, self._offset)
+
+    def expect(self, text):
+        """
+        Consume the next non-whitespace text, or reject the request.
+
+        :param str text: Expected text.
+
+        """
+        if not self.startswith(text):
+            abort(400)
+        self._offset += len(text)
+
+    def expect_end(self):
+        """
+        Reject the request if there is more than whitespace left.
+
+        """
+        self._skip_whitespace()
+        if self._offset < len(self._buffer):
+            abort(400)
+
+    def decode_value(self):
+        """
+        Decode the next JSON value, reading more chunks until it is complete.
+
+        :rtype: any
+
+        """
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer,
+                                                      self._offset)
+            except json.JSONDecodeError:
+                value, end = None, None
+            # A value at the end of the buffer may continue in the next chunk
+            if end is not None and (end < len(self._buffer) or self._eof):
+                self._offset = end
+                return value
+            if self._eof:
+                abort(400)
+            self._read(len(self._buffer) - self._offset)
+
+    def decode_rest(self):
+        """
+        Decode the rest of the body as one JSON value.
+
+        :rtype: any
+
+        """
+        while not self._eof:
+            self._read()
+        value = self.decode_value()
+        self.expect_end()
+        return value
+
+    def _skip_whitespace(self):
+        """
+        Skip whitespace, reading more chunks if needed.
+
+        """
+        while True:
+            while (self._offset < len(self._buffer) and
+                   self._buffer[self._offset] in ' \t\r\n'):
+                self._offset += 1
+            if self._offset < len(self._buffer) or self._eof:
+                return
+            self._read()
+
+    def _read(self, min_size=0):
+        """
+        Read chunks into the buffer and drop text that has been consumed.
+
+        :param int min_size: Read at least this many characters, so that
+                             retries of large values grow the buffer
+                             geometrically.
+
+        """
+        self._buffer = self._buffer[self._offset:]
+        self._offset = 0
+        target = len(self._buffer) + max(min_size, 1)
+        try:
+            while len(self._buffer) < target:
+                try:
+                    chunk = next(self._chunks)
+                except StopIteration:
+                    self._buffer += self._utf8.decode(b'', final=True)
+                    self._eof = True
+                    return
+                self._buffer += self._utf8.decode(chunk)
+        except UnicodeDecodeError:
+            abort(400)
 
 
 class RequestHandler:
@@ -25,17 +267,30 @@ class RequestHandler:
         """
         Parse request arguments
 
+        URL encoded forms and JSON bodies are parsed incrementally from the
+        request stream, see StreamingBodyParser.
+
         :rtype:  json
         :return: Arguments.
 
         """
         args = {}
         if request.method == 'PUT' or request.method == 'POST':
-            if len(request.form) > 0:
+            if request.mimetype == 'application/x-www-form-urlencoded':
+                for key, value in StreamingBodyParser.iter_form(
+                        request.stream):
+                    args.setdefault(key, value)
+            elif request.is_json:
+                for key, value in StreamingBodyParser.iter_json(
+                        request.stream):
+                    if key is None:
+                        return value
+                    args[key] = value
+            elif len(request.form) > 0:
                 for key in request.form.keys():
                     args[key] = request.form.get(key)
             else:
-                args = request.get_json()
+                args = None
         else:
             for key in request.args.keys():
                 args[key] = request.args.getlist(key)
@@ -47,10 +302,1335 @@ class RequestHandler:
 
         """
         args = RequestHandler._get_request_arguments()
+        return response_cache.respond(request.path, args,
+                                      lambda: self._render(args))
+
+    @staticmethod
+    def _render(args):
+        """
+        Render the response of a HTTP request.
+
+        :param dict args: Request arguments.
+
+        """
         if request.path == '/':
             return render_template('index.html')
         elif request.path == '/post.html':
-            return render_template('post.html')
+            return RequestHandler._stream_template('post.html')
+
+    @staticmethod
+    def _stream_template(template_name, **context):
+        """
+        Render a template as a streamed response.
+
+        The template is rendered piece by piece while the response is sent,
+        so large results are never held in memory as a whole.
+
+        :param str template_name: Name of the template.
+        :param context:           Template variables.
+        :rtype: Response
+
+        """
+        web_server.update_template_context(context)
+        template = web_server.jinja_env.get_template(template_name)
+        return Response(stream_with_context(template.generate(context)))
+
+
+class MemoryCacheStore:
+    """Response cache store in the memory of one process."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        Initializes a MemoryCacheStore instance.
+
+        :param int max_bytes: Max total size of cached bodies, least recently
+                              used responses are evicted above it.
+
+        """
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, route, key):
+        """
+        Get a cached response.
+
+        :param str route: Route of the response.
+        :param str key:   Cache key of the response.
+        :rtype:  tuple
+        :return: Body, mimetype, ETag and expiry time, or None.
+
+        """
+        with self._lock:
+            entry = self._entries.get((route, key))
+            if entry is not None:
+                self._entries.move_to_end((route, key))
+            return entry
+
+    def set(self, route, key, entry):
+        """
+        Cache a response.
+
+        :param str route:   Route of the response.
+        :param str key:     Cache key of the response.
+        :param tuple entry: Body, mimetype, ETag and expiry time.
+
+        """
+        with self._lock:
+            self._delete((route, key))
+            self._entries[(route, key)] = entry
+            self._bytes += len(entry[0])
+            while self._bytes > self._max_bytes:
+                self._delete(next(iter(self._entries)))
+
+    def delete(self, route=None, key=None):
+        """
+        Remove cached responses.
+
+        :param str route: Route to remove responses for, all if None.
+        :param str key:   Cache key to remove, all keys of the route if None.
+
+        """
+        with self._lock:
+            for entry_key in list(self._entries):
+                if route is None or (entry_key[0] == route and
+                                     key in (None, entry_key[1])):
+                    self._delete(entry_key)
+
+    def _delete(self, entry_key):
+        """
+        Remove a cached response.
+
+        :param tuple entry_key: Route and cache key.
+
+        """
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+
+class DiskCacheStore:
+    """
+    Response cache store in a directory shared by all processes.
+
+    Each response is stored in its own file, written to a temporary file and
+    renamed into place. The access time of the file is used for least
+    recently used eviction.
+
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        """
+        Initializes a DiskCacheStore instance.
+
+        :param str directory: Directory to store cached responses in.
+        :param int max_bytes: Max total size of cached files, least recently
+                              used responses are evicted above it.
+
+        """
+        self._directory = directory
+        self._max_bytes = max_bytes
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def get(self, route, key):
+        """
+        Get a cached response.
+
+        :param str route: Route of the response.
+        :param str key:   Cache key of the response.
+        :rtype:  tuple
+        :return: Body, mimetype, ETag and expiry time, or None.
+
+        """
+        file_name = self._file_name(route, key)
+        try:
+            with open(file_name, 'rb') as file_obj:
+                header = json.loads(file_obj.readline().decode('utf-8'))
+                body = file_obj.read()
+            os.utime(file_name)
+        except (OSError, ValueError):
+            return None
+        return body, header['mimetype'], header['etag'], header['expires']
+
+    def set(self, route, key, entry):
+        """
+        Cache a response.
+
+        :param str route:   Route of the response.
+        :param str key:     Cache key of the response.
+        :param tuple entry: Body, mimetype, ETag and expiry time.
+
+        """
+        body, mimetype, etag, expires = entry
+        header = json.dumps(
+            {'mimetype': mimetype, 'etag': etag, 'expires': expires})
+        file_name = self._file_name(route, key)
+        tmp_file_name = '{}.{}~'.format(file_name, os.getpid())
+        with open(tmp_file_name, 'wb') as file_obj:
+            file_obj.write(header.encode('utf-8') + b'\n' + body)
+        os.rename(tmp_file_name, file_name)
+        self._evict()
+
+    def delete(self, route=None, key=None):
+        """
+        Remove cached responses.
+
+        :param str route: Route to remove responses for, all if None.
+        :param str key:   Cache key to remove, all keys of the route if None.
+
+        """
+        if route is not None and key is not None:
+            file_names = [self._file_name(route, key)]
+        else:
+            prefix = '' if route is None else self._hash(route)[:16]
+            file_names = [i.path for i in os.scandir(self._directory)
+                          if i.name.startswith(prefix) and
+                          i.name.endswith('.cache')]
+        for file_name in file_names:
+            try:
+                os.unlink(file_name)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """
+        Remove least recently used responses until the size limit is met.
+
+        """
+        files = []
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith('.cache'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(i[1] for i in files)
+        for _, size, file_name in sorted(files):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.unlink(file_name)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _file_name(self, route, key):
+        """
+        Get the file name of a cached response.
+
+        :param str route: Route of the response.
+        :param str key:   Cache key of the response.
+        :rtype: str
+
+        """
+        return os.path.join(self._directory, '{}-{}.cache'.format(
+            self._hash(route)[:16], self._hash(key)[:32]))
+
+    @staticmethod
+    def _hash(value):
+        """
+        Hash a string.
+
+        :param str value: String to hash.
+        :rtype: str
+
+        """
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache of rendered responses.
+
+    Responses to GET and HEAD requests are cached per route and request
+    arguments. Cached responses carry an ETag, and requests with a matching
+    If-None-Match header get a 304 response without a body.
+
+    """
+
+    def __init__(self, store=None, ttl=60):
+        """
+        Initializes a ResponseCache instance.
+
+        :param store:   MemoryCacheStore, DiskCacheStore or None to disable
+                        caching.
+        :param int ttl: Seconds a cached response is valid.
+
+        """
+        self.store = store
+        self.ttl = ttl
+        self._stats = multiprocessing.Array('q', 3)
+
+    def respond(self, route, args, render):
+        """
+        Get a response from the cache, or render and cache it.
+
+        :param str route:       Route of the request.
+        :param dict args:       Request arguments.
+        :param function render: Function that renders the response.
+        :rtype:  Response
+        :return: Response.
+
+        """
+        if self.store is None or request.method not in ('GET', 'HEAD'):
+            return render()
+        key = json.dumps(args, sort_keys=True, default=str)
+        entry = self.store.get(route, key)
+        if entry is not None and entry[3] < time.time():
+            self.store.delete(route, key)
+            entry = None
+        self._count(0 if entry is not None else 1)
+        if entry is None:
+            response = web_server.make_response(render())
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            body = response.get_data()
+            etag = hashlib.sha1(body).hexdigest()
+            entry = (body, response.mimetype, etag, time.time() + self.ttl)
+            self.store.set(route, key, entry)
+        response = Response(entry[0], mimetype=entry[1])
+        response.set_etag(entry[2])
+        response.make_conditional(request)
+        if response.status_code == 304:
+            self._count(2)
+        return response
+
+    def invalidate(self, route=None, args=None):
+        """
+        Remove cached responses.
+
+        :param str route: Route to remove responses for, all if None.
+        :param dict args: Request arguments to remove the response for, all
+                          responses of the route if None.
+
+        """
+        if self.store is None:
+            return
+        key = None
+        if args is not None:
+            key = json.dumps(args, sort_keys=True, default=str)
+        self.store.delete(route, key)
+
+    def stats(self):
+        """
+        Get cache statistics of all processes.
+
+        :rtype:  dict
+        :return: Number of hits, misses and not modified responses.
+
+        """
+        with self._stats.get_lock():
+            hits, misses, not_modified = self._stats[:]
+        return {'hits': hits, 'misses': misses, 'not_modified': not_modified}
+
+    def render(self):
+        """
+        Render cache statistics in Prometheus text format.
+
+        :rtype: str
+
+        """
+        lines = ['# HELP flask_response_cache_total Response cache lookups.',
+                 '# TYPE flask_response_cache_total counter']
+        for result, value in sorted(self.stats().items()):
+            lines.append('flask_response_cache_total{{result="{}"}} {}'.format(
+                result, value))
+        return '\n'.join(lines) + '\n'
+
+    def _count(self, index):
+        """
+        Increment a statistics counter.
+
+        :param int index: Index of the counter.
+
+        """
+        with self._stats.get_lock():
+            self._stats[index] += 1
+
+
+class RequestMetrics:
+    """
+    Request metrics shared by all web server processes.
+
+    Counters are kept in a shared memory array that is allocated before the
+    web server forks, so all worker processes update the same counters.
+
+    """
+
+    LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0]
+    """(*list*) Upper bounds in seconds of the latency histogram buckets."""
+
+    __COUNT = 0
+    """(*int*) Offset of the request counter of a route."""
+
+    __BYTES = 1
+    """(*int*) Offset of the response size counter of a route."""
+
+    __LATENCY_SUM = 2
+    """(*int*) Offset of the latency sum, in microseconds, of a route."""
+
+    __BUCKETS = 3
+    """(*int*) Offset of the first latency bucket of a route."""
+
+    def __init__(self, routes):
+        """
+        Initializes a RequestMetrics instance.
+
+        :param list routes: Routes to keep metrics for, other routes are
+                            counted as "other".
+
+        """
+        self._routes = list(routes) + ['other']
+        self._route_index = {route: i for i, route in enumerate(self._routes)}
+        self._stride = RequestMetrics.__BUCKETS + len(
+            RequestMetrics.LATENCY_BUCKETS) + 1
+        self._in_flight = len(self._routes) * self._stride
+        self._counters = multiprocessing.Array('q', self._in_flight + 1)
+
+    def handle(self, handler, route):
+        """
+        Call a request handler and record metrics for it.
+
+        Streamed responses are recorded when they have been sent, so their
+        latency includes streaming and their size is counted as they are
+        sent.
+
+        :param function handler: Request handler.
+        :param str route:        Route of the request.
+        :rtype:  Response
+        :return: Response of the request handler.
+
+        """
+        with self._counters.get_lock():
+            self._counters[self._in_flight] += 1
+        start = time.perf_counter()
+        try:
+            response = web_server.make_response(handler())
+        except BaseException:
+            self._record(route, time.perf_counter() - start, 0)
+            raise
+        if response.is_streamed and not response.direct_passthrough:
+            response.response = _CountingIterator(
+                response.response, lambda size: self._record(
+                    route, time.perf_counter() - start, size))
+            return response
+        self._record(route, time.perf_counter() - start,
+                     response.calculate_content_length() or 0)
+        return response
+
+    def render(self):
+        """
+        Render metrics in Prometheus text format.
+
+        :rtype: str
+
+        """
+        with self._counters.get_lock():
+            counters = self._counters[:]
+        lines = [
+            '# HELP flask_http_requests_in_flight Requests being handled.',
+            '# TYPE flask_http_requests_in_flight gauge',
+            'flask_http_requests_in_flight {}'.format(
+                counters[self._in_flight]),
+            '# HELP flask_http_requests_total Handled requests.',
+            '# TYPE flask_http_requests_total counter']
+        for i, route in enumerate(self._routes):
+            lines.append('flask_http_requests_total{{route="{}"}} {}'.format(
+                route, counters[i*self._stride+RequestMetrics.__COUNT]))
+        lines += [
+            '# HELP flask_http_response_size_bytes_total Response body bytes.',
+            '# TYPE flask_http_response_size_bytes_total counter']
+        for i, route in enumerate(self._routes):
+            lines.append(
+                'flask_http_response_size_bytes_total{{route="{}"}} '
+                '{}'.format(
+                    route, counters[i*self._stride+RequestMetrics.__BYTES]))
+        lines += [
+            '# HELP flask_http_request_duration_seconds Request latency.',
+            '# TYPE flask_http_request_duration_seconds histogram']
+        bounds = [str(i) for i in RequestMetrics.LATENCY_BUCKETS] + ['+Inf']
+        for i, route in enumerate(self._routes):
+            base = i * self._stride
+            cumulative = 0
+            for j, bound in enumerate(bounds):
+                cumulative += counters[base+RequestMetrics.__BUCKETS+j]
+                lines.append(
+                    'flask_http_request_duration_seconds_bucket'
+                    '{{route="{}",le="{}"}} {}'.format(
+                        route, bound, cumulative))
+            lines.append(
+                'flask_http_request_duration_seconds_sum{{route="{}"}} '
+                '{}'.format(
+                    route,
+                    counters[base+RequestMetrics.__LATENCY_SUM] / 1e6))
+            lines.append(
+                'flask_http_request_duration_seconds_count{{route="{}"}} '
+                '{}'.format(route, counters[base+RequestMetrics.__COUNT]))
+        return '\n'.join(lines) + '\n'
+
+    def _record(self, route, latency, size):
+        """
+        Record a handled request.
+
+        :param str route:     Route of the request.
+        :param float latency: Time taken to handle the request in seconds.
+        :param int size:      Size of the response body in bytes.
+
+        """
+        base = self._route_index.get(
+            route, len(self._routes) - 1) * self._stride
+        bucket = len(RequestMetrics.LATENCY_BUCKETS)
+        for i, bound in enumerate(RequestMetrics.LATENCY_BUCKETS):
+            if latency <= bound:
+                bucket = i
+                break
+        with self._counters.get_lock():
+            self._counters[self._in_flight] -= 1
+            self._counters[base+RequestMetrics.__COUNT] += 1
+            self._counters[base+RequestMetrics.__BYTES] += size
+            self._counters[base+RequestMetrics.__LATENCY_SUM] += int(
+                latency * 1e6)
+            self._counters[base+RequestMetrics.__BUCKETS+bucket] += 1
+
+
+class _CountingIterator:
+    """
+    Response body iterator that counts the bytes it yields.
+
+    """
+
+    def __init__(self, iterable, on_close):
+        """
+        Initializes a _CountingIterator instance.
+
+        :param iterable:          Response body.
+        :param function on_close: Called with the number of bytes yielded
+                                  when the iterator is closed.
+
+        """
+        self._iterable = iterable
+        self._iterator = iter(iterable)
+        self._on_close = on_close
+        self._size = 0
+
+    def __iter__(self):
+        """
+        Get the iterator.
+
+        """
+        return self
+
+    def __next__(self):
+        """
+        Get the next chunk of the response body.
+
+        """
+        chunk = next(self._iterator)
+        self._size += len(chunk if isinstance(chunk, bytes)
+                          else chunk.encode('utf-8'))
+        return chunk
+
+    def close(self):
+        """
+        Close the response body and report the number of bytes yielded.
+
+        """
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            if self._on_close is not None:
+                on_close, self._on_close = self._on_close, None
+                on_close(self._size)
+
+
+class StaticAssets:
+    """
+    Pre-compressed and fingerprinted static files.
+
+    When built, every file in the static folder is hashed and compressible
+    files are compressed with gzip, and with brotli if it is installed, into
+    a separate folder. Files are served in the best encoding the client
+    accepts. Fingerprinted URLs, from asset_url in templates, are cached by
+    clients for a year, other URLs are revalidated with ETags. A file that
+    changes after the build is built again when it is requested.
+
+    """
+
+    ENCODINGS = ['br', 'gzip']
+    """(*list*) Content encodings in order of preference."""
+
+    COMPRESSIBLE_TYPES = ['application/javascript', 'application/json',
+                          'application/xml', 'image/svg+xml']
+    """(*list*) Mimetypes that are compressed, in addition to text/*."""
+
+    MIN_COMPRESS_SIZE = 256
+    """(*int*) Files smaller than this many bytes are not compressed."""
+
+    IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+    """(*str*) Cache-Control of fingerprinted URLs."""
+
+    REVALIDATE_CACHE_CONTROL = 'no-cache'
+    """(*str*) Cache-Control of other URLs."""
+
+    def __init__(self, app, compressed_folder=None):
+        """
+        Initializes a StaticAssets instance.
+
+        Replaces the static file view of the application.
+
+        :param Flask app:             Flask application.
+        :param str compressed_folder: Folder to write compressed files to, if
+                                      None "html_static_compressed" next to
+                                      the application.
+
+        """
+        self._app = app
+        self._compressed_folder = compressed_folder or os.path.join(
+            app.root_path, 'html_static_compressed')
+        self._assets = None
+        self._fingerprints = {}
+        self._default_view = app.view_functions['static']
+        app.view_functions['static'] = self.serve
+        app.add_template_global(self.asset_url)
+
+    def build(self):
+        """
+        Hash and compress all files in the static folder.
+
+        Compressed files that are newer than their source are reused. Files
+        that can not be read are left to the default static file view.
+
+        """
+        assets = {}
+        fingerprints = {}
+        static_folder = self._app.static_folder
+        if static_folder is not None and os.path.isdir(static_folder):
+            for root, _, files in os.walk(static_folder):
+                for name in files:
+                    path = os.path.join(root, name)
+                    logical = os.path.relpath(
+                        path, static_folder).replace(os.sep, '/')
+                    try:
+                        asset = self._build_asset(path, logical)
+                    except OSError:
+                        continue
+                    assets[logical] = asset
+                    fingerprints[asset['url']] = logical
+        self._fingerprints = fingerprints
+        self._assets = assets
+
+    def asset_url(self, filename):
+        """
+        Get the fingerprinted URL of a static file, for use in templates.
+
+        :param str filename: Path of the file relative to the static folder.
+        :rtype: str
+
+        """
+        if self._assets is None:
+            self.build()
+        asset = self._assets.get(filename)
+        url = filename if asset is None else asset['url']
+        return '{}/{}'.format(self._app.static_url_path or '', url)
+
+    def serve(self, filename):
+        """
+        Serve a static file in the best accepted encoding.
+
+        :param str filename: Requested path relative to the static URL path.
+        :rtype: Response
+
+        """
+        if self._assets is None:
+            self.build()
+        logical = self._fingerprints.get(filename, filename)
+        asset = self._get_current_asset(logical)
+        if asset is None or filename not in (logical, asset['url']):
+            return self._default_view(filename=filename)
+        encoding = None
+        for name in StaticAssets.ENCODINGS:
+            if name in asset['encodings'] and request.accept_encodings[name]:
+                encoding = name
+                break
+        path = asset['path'] if encoding is None else (
+            asset['encodings'][encoding])
+        response = send_file(path, mimetype=asset['mimetype'],
+                             conditional=False)
+        response.set_etag(asset['hash'] if encoding is None else
+                          '{}-{}'.format(asset['hash'], encoding))
+        response.headers.pop('Content-Disposition', None)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = (
+            StaticAssets.IMMUTABLE_CACHE_CONTROL if filename != logical else
+            StaticAssets.REVALIDATE_CACHE_CONTROL)
+        return response.make_conditional(request)
+
+    def _get_current_asset(self, logical):
+        """
+        Get an asset, built again if its file changed since it was built.
+
+        :param str logical: Path of the file relative to the static folder.
+        :rtype:  dict
+        :return: Asset information or None.
+
+        """
+        asset = self._assets.get(logical)
+        if asset is None:
+            return None
+        try:
+            stat = os.stat(asset['path'])
+            if (stat.st_mtime_ns, stat.st_size) == asset['stat']:
+                return asset
+            new_asset = self._build_asset(asset['path'], logical)
+        except OSError:
+            new_asset = None
+        self._fingerprints.pop(asset['url'], None)
+        if new_asset is None:
+            self._assets.pop(logical, None)
+        else:
+            self._fingerprints[new_asset['url']] = logical
+            self._assets[logical] = new_asset
+        return new_asset
+
+    def _build_asset(self, path, logical):
+        """
+        Hash and compress one static file.
+
+        :param str path:    Full path to the file.
+        :param str logical: Path of the file relative to the static folder.
+        :rtype:  dict
+        :return: Asset information.
+        :raises OSError: If the file can not be read.
+
+        """
+        stat = os.stat(path)
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file_obj:
+            for block in iter(lambda: file_obj.read(1024 * 1024), b''):
+                digest.update(block)
+        file_hash = digest.hexdigest()[:16]
+        mimetype = (mimetypes.guess_type(logical)[0] or
+                    'application/octet-stream')
+        base, extension = os.path.splitext(logical)
+        asset = {'path': path, 'hash': file_hash, 'mimetype': mimetype,
+                 'url': '{}.{}{}'.format(base, file_hash[:12], extension),
+                 'stat': (stat.st_mtime_ns, stat.st_size), 'encodings': {}}
+        if (stat.st_size < StaticAssets.MIN_COMPRESS_SIZE or not (
+                mimetype.startswith('text/') or
+                mimetype in StaticAssets.COMPRESSIBLE_TYPES)):
+            return asset
+        compressors = {'gzip': ('.gz', lambda data: gzip.compress(data, 9))}
+        if brotli is not None:
+            compressors['br'] = ('.br', brotli.compress)
+        for encoding, (suffix, compress) in compressors.items():
+            compressed_path = os.path.join(self._compressed_folder,
+                                           logical + suffix)
+            try:
+                if os.stat(compressed_path).st_mtime_ns >= stat.st_mtime_ns:
+                    asset['encodings'][encoding] = compressed_path
+                    continue
+            except OSError:
+                pass
+            with open(path, 'rb') as file_obj:
+                data = file_obj.read()
+            compressed = compress(data)
+            if len(compressed) >= len(data):
+                continue
+            tmp_path = '{}.{}~'.format(compressed_path, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(compressed_path), exist_ok=True)
+                with open(tmp_path, 'wb') as file_obj:
+                    file_obj.write(compressed)
+                os.rename(tmp_path, compressed_path)
+            except OSError:
+                # Served uncompressed, e.g. if the folder is read-only
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+                continue
+            asset['encodings'][encoding] = compressed_path
+        return asset
+
+
+class AsyncServer:
+    """
+    HTTP server running on an asyncio event loop.
+
+    Connections are handled by the event loop, and the WSGI application is
+    called in a thread pool. A slow request handler only occupies one thread,
+    while the event loop keeps serving other connections.
+
+    """
+
+    MAX_HEADER_SIZE = 64 * 1024
+    """(*int*) Max size in bytes of the request line and headers."""
+
+    GRACEFUL_TIMEOUT = 30
+    """(*int*) Seconds to wait for requests to finish when stopping."""
+
+    def __init__(self, app, host='0.0.0.0', port=5000, threads=32,
+                 max_requests=0):
+        """
+        Initializes an AsyncServer instance.
+
+        :param app:              WSGI application.
+        :param str host:         Host to listen on.
+        :param int port:         Port to listen on.
+        :param int threads:      Number of threads calling the WSGI
+                                 application.
+        :param int max_requests: Stop after this many requests, if set to 0
+                                 the server never stops by itself.
+
+        """
+        self._app = app
+        self._host = host
+        self._port = port
+        self._max_requests = max_requests
+        self._pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self._requests = 0
+        self._stopped = None
+        self._connections = {}
+
+    def run(self, sock=None):
+        """
+        Serve HTTP requests until interrupted, SIGTERM or max requests.
+
+        Stopping is graceful, the server stops accepting connections and
+        waits up to GRACEFUL_TIMEOUT seconds for requests in progress.
+
+        :param socket sock: Listening socket to use, if None a socket is
+                            opened on the host and port.
+
+        """
+        try:
+            asyncio.run(self._serve(sock))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._pool.shutdown(wait=False)
+
+    def stop(self):
+        """
+        Stop the server gracefully, must be called from the event loop.
+
+        """
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def _serve(self, sock):
+        """
+        Start the server and serve until stopped.
+
+        :param socket sock: Listening socket to use or None.
+
+        """
+        self._stopped = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM,
+                                                      self.stop)
+        if sock is None:
+            server = await asyncio.start_server(
+                self._handle_connection, self._host, self._port,
+                limit=AsyncServer.MAX_HEADER_SIZE)
+        else:
+            server = await asyncio.start_server(
+                self._handle_connection, sock=sock,
+                limit=AsyncServer.MAX_HEADER_SIZE)
+        async with server:
+            await self._stopped.wait()
+            server.close()
+            for task, busy in list(self._connections.items()):
+                if not busy:
+                    task.cancel()
+            if len(self._connections) > 0:
+                await asyncio.wait(list(self._connections),
+                                   timeout=AsyncServer.GRACEFUL_TIMEOUT)
+            for task in list(self._connections):
+                task.cancel()
+
+    async def _handle_connection(self, reader, writer):
+        """
+        Handle the requests of one connection.
+
+        :param asyncio.StreamReader reader: Connection reader.
+        :param asyncio.StreamWriter writer: Connection writer.
+
+        """
+        task = asyncio.current_task()
+        self._connections[task] = False
+        try:
+            keep_alive = True
+            while keep_alive and not self._stopped.is_set():
+                self._connections[task] = False
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._send_error(writer, '431 Request Header '
+                                                   'Fields Too Large')
+                    return
+                self._connections[task] = True
+                self._requests += 1
+                if 0 < self._max_requests <= self._requests:
+                    self.stop()
+                try:
+                    method, target, version, headers = self._parse_head(head)
+                    length = headers.get('content-length', '0')
+                    # Only digits, int() also accepts signs and underscores
+                    if not (length.isascii() and length.isdigit()):
+                        raise ValueError(length)
+                    length = int(length)
+                except ValueError:
+                    await self._send_error(writer, '400 Bad Request')
+                    return
+                if 'chunked' in headers.get('transfer-encoding', ''):
+                    await self._send_error(writer, '411 Length Required')
+                    return
+                max_size = getattr(self._app, 'config', {}).get(
+                    'MAX_CONTENT_LENGTH')
+                if max_size is not None and length > max_size:
+                    await self._send_error(writer, '413 Content Too Large')
+                    return
+                body = _StreamInput(reader, length,
+                                    asyncio.get_running_loop())
+                connection = headers.get('connection', '').lower()
+                keep_alive = not self._stopped.is_set() and (
+                    (version == 'HTTP/1.1' and connection != 'close') or
+                    (version == 'HTTP/1.0' and connection == 'keep-alive'))
+                environ = self._environ(method, target, version, headers,
+                                        body, writer)
+                keep_alive = await self._respond(environ, writer, keep_alive)
+                # Skip what the application did not read of the body
+                await body.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._connections[task]
+            writer.close()
+
+    async def _respond(self, environ, writer, keep_alive):
+        """
+        Call the WSGI application in the thread pool and send its response.
+
+        :param dict environ:                WSGI environment.
+        :param asyncio.StreamWriter writer: Connection writer.
+        :param bool keep_alive:             If the client wants to keep the
+                                            connection open.
+        :rtype:  bool
+        :return: If the connection can be kept open.
+
+        """
+        loop = asyncio.get_running_loop()
+        started = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and 'sent' in started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'] = status
+            started['headers'] = headers
+            return written.append
+
+        result = await loop.run_in_executor(self._pool, self._app, environ,
+                                            start_response)
+        try:
+            # Files are sent with sendfile if the length is known up front
+            length = None
+            if (isinstance(result, _FileWrapper) and 'status' in started and
+                    len(written) == 0):
+                length = dict((name.lower(), value) for name, value in
+                              started['headers']).get('content-length')
+            if length is None:
+                chunks = iter(result)
+                first = await loop.run_in_executor(self._pool, next, chunks,
+                                                   None)
+            started['sent'] = True
+            headers = list(started['headers'])
+            names = {name.lower() for name, _ in headers}
+            chunked = 'content-length' not in names
+            if chunked and environ['SERVER_PROTOCOL'] != 'HTTP/1.1':
+                chunked = False
+                keep_alive = False
+            if chunked:
+                headers.append(('Transfer-Encoding', 'chunked'))
+            if 'date' not in names:
+                headers.append(
+                    ('Date', email.utils.formatdate(usegmt=True)))
+            headers.append(
+                ('Connection', 'keep-alive' if keep_alive else 'close'))
+            head = 'HTTP/1.1 {}\r\n{}\r\n'.format(
+                started['status'],
+                ''.join('{}: {}\r\n'.format(*i) for i in headers))
+            writer.write(head.encode('latin-1'))
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                await writer.drain()
+                return keep_alive
+            if length is not None:
+                await writer.drain()
+                file_obj = result.filelike
+                await loop.sendfile(writer.transport, file_obj,
+                                    file_obj.tell(), int(length))
+                return keep_alive
+            chunk = b''.join(written) + (first or b'')
+            while chunk is not None:
+                if len(chunk) > 0:
+                    if chunked:
+                        writer.write('{:x}\r\n'.format(len(chunk)).encode())
+                        writer.write(chunk)
+                        writer.write(b'\r\n')
+                    else:
+                        writer.write(chunk)
+                    await writer.drain()
+                chunk = await loop.run_in_executor(self._pool, next, chunks,
+                                                   None)
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+            return keep_alive
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self._pool, result.close)
+
+    def _environ(self, method, target, version, headers, body, writer):
+        """
+        Create the WSGI environment of a request.
+
+        :param str method:                  Request method.
+        :param str target:                  Request target.
+        :param str version:                 HTTP version.
+        :param dict headers:                Request headers, lower case names.
+        :param _StreamInput body:           Request body.
+        :param asyncio.StreamWriter writer: Connection writer.
+        :rtype: dict
+
+        """
+        path, _, query = target.partition('?')
+        peer = writer.get_extra_info('peername') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self._host,
+            'SERVER_PORT': str(self._port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': str(peer[0]),
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(body.length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': _FileWrapper}
+        for name, value in headers.items():
+            if name not in ('content-type', 'content-length'):
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+        return environ
+
+    @staticmethod
+    def _parse_head(head):
+        """
+        Parse the request line and headers of a request.
+
+        :param bytes head: Request line and headers.
+        :rtype:  tuple
+        :return: Method, target, HTTP version and headers with lower case
+                 names.
+
+        """
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ')
+        if not version.startswith('HTTP/1.'):
+            raise ValueError(version)
+        headers = {}
+        for line in lines[1:]:
+            if len(line) == 0:
+                continue
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            if name in headers:
+                headers[name] += ', ' + value.strip()
+            else:
+                headers[name] = value.strip()
+        return method, target, version, headers
+
+    @staticmethod
+    async def _send_error(writer, status):
+        """
+        Send an error response and close the connection.
+
+        :param asyncio.StreamWriter writer: Connection writer.
+        :param str status:                  Response status.
+
+        """
+        writer.write('HTTP/1.1 {}\r\nContent-Length: 0\r\n'
+                     'Connection: close\r\n\r\n'.format(status).encode())
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class _StreamInput(io.RawIOBase):
+    """
+    Request body read from the connection while the application reads it.
+
+    The application runs in a thread pool, every read waits for the event loop
+    to receive the data, so the body is never buffered in full.
+
+    """
+
+    def __init__(self, reader, length, loop):
+        """
+        Initializes a _StreamInput instance.
+
+        :param asyncio.StreamReader reader:    Connection reader.
+        :param int length:                     Length of the body in bytes.
+        :param asyncio.AbstractEventLoop loop: Event loop of the connection.
+
+        """
+        super().__init__()
+        self.length = length
+        self._reader = reader
+        self._remaining = length
+        self._loop = loop
+
+    def readable(self):
+        """
+        The body is readable.
+
+        """
+        return True
+
+    def readinto(self, buffer):
+        """
+        Read from the connection into a buffer.
+
+        :param buffer: Buffer to read into.
+        :rtype:  int
+        :return: Number of bytes read, 0 at the end of the body.
+
+        """
+        if self._remaining == 0:
+            return 0
+        data = asyncio.run_coroutine_threadsafe(
+            self._reader.read(min(len(buffer), self._remaining)),
+            self._loop).result()
+        if len(data) == 0:
+            # The client closed the connection before sending the body
+            self._remaining = 0
+            return 0
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    async def drain(self):
+        """
+        Read and discard the rest of the body, must be called from the event
+        loop.
+
+        """
+        while self._remaining > 0:
+            data = await self._reader.read(
+                min(self._remaining, StreamingBodyParser.CHUNK_SIZE))
+            if len(data) == 0:
+                raise asyncio.IncompleteReadError(b'', self._remaining)
+            self._remaining -= len(data)
+
+
+class _FileWrapper:
+    """
+    WSGI file wrapper of AsyncServer.
+
+    AsyncServer sends wrapped files with sendfile instead of iterating them.
+
+    """
+
+    def __init__(self, filelike, block_size=8192):
+        """
+        Initializes a _FileWrapper instance.
+
+        :param filelike:       File object opened in binary mode.
+        :param int block_size: Number of bytes to read at a time when
+                               iterated.
+
+        """
+        self.filelike = filelike
+        self._block_size = block_size
+
+    def __iter__(self):
+        """
+        Iterate the file in blocks.
+
+        """
+        while True:
+            block = self.filelike.read(self._block_size)
+            if len(block) == 0:
+                return
+            yield block
+
+    def close(self):
+        """
+        Close the file.
+
+        """
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
+class PreforkServer:
+    """
+    Pre-forked web server.
+
+    A master process opens the listening socket and forks worker processes
+    that share it. Each worker serves requests with an AsyncServer and its
+    thread pool. The master restarts workers that exit, replaces all workers
+    gracefully on SIGHUP and stops them gracefully on SIGTERM or SIGINT.
+
+    """
+
+    def __init__(self, app, host='0.0.0.0', port=5000, workers=None,
+                 threads=32, max_requests=0):
+        """
+        Initializes a PreforkServer instance.
+
+        :param app:              WSGI application.
+        :param str host:         Host to listen on.
+        :param int port:         Port to listen on.
+        :param int workers:      Number of worker processes, if None the
+                                 number of CPUs.
+        :param int threads:      Number of threads in each worker.
+        :param int max_requests: Replace a worker after this many requests,
+                                 if set to 0 workers are never replaced.
+
+        """
+        self._app = app
+        self._host = host
+        self._port = port
+        self._worker_count = workers or os.cpu_count() or 1
+        self._threads = threads
+        self._max_requests = max_requests
+        self._workers = {}
+        self._generation = 0
+        self._signals = []
+
+    def run(self):
+        """
+        Start the workers and supervise them until stopped.
+
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self._host, self._port))
+        sock.listen(socket.SOMAXCONN)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, _: self._signals.append(
+                signum))
+        try:
+            for _ in range(self._worker_count):
+                self._spawn_worker(sock)
+            while True:
+                self._reap_workers(sock)
+                while len(self._signals) > 0:
+                    if self._signals.pop(0) != signal.SIGHUP:
+                        return
+                    self._restart_workers(sock)
+                time.sleep(0.5)
+        finally:
+            self._stop_workers()
+            sock.close()
+
+    def _spawn_worker(self, sock):
+        """
+        Fork a worker process.
+
+        :param socket sock: Listening socket.
+
+        """
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            code = 0
+            try:
+                AsyncServer(self._app, self._host, self._port, self._threads,
+                            self._max_requests).run(sock)
+            except Exception:
+                code = 1
+                sys.excepthook(*sys.exc_info())
+            finally:
+                os._exit(code)
+        self._workers[pid] = self._generation
+
+    def _reap_workers(self, sock):
+        """
+        Collect exited workers and replace those of the current generation.
+
+        :param socket sock: Listening socket.
+
+        """
+        while len(self._workers) > 0:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self._workers.pop(pid, None)
+            if generation == self._generation:
+                self._spawn_worker(sock)
+
+    def _restart_workers(self, sock):
+        """
+        Start new workers and stop the old ones gracefully.
+
+        :param socket sock: Listening socket.
+
+        """
+        old_workers = list(self._workers)
+        self._generation += 1
+        for _ in range(self._worker_count):
+            self._spawn_worker(sock)
+        for pid in old_workers:
+            self._kill(pid, signal.SIGTERM)
+
+    def _stop_workers(self):
+        """
+        Stop all workers gracefully and wait for them to exit.
+
+        """
+        self._generation += 1
+        for pid in list(self._workers):
+            self._kill(pid, signal.SIGTERM)
+        for pid in list(self._workers):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            del self._workers[pid]
+
+    @staticmethod
+    def _kill(pid, signum):
+        """
+        Send a signal to a worker that may already have exited.
+
+        :param int pid:    Process id.
+        :param int signum: Signal number.
+
+        """
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
 
 
 class Main:
@@ -65,11 +1645,49 @@ class Main:
 
         """
         debug_help = 'Debugging printout level.'
+        cache_help = ('Response cache, "none", "memory" for a cache per '
+                      'process or a directory for a cache shared by all '
+                      'processes. Defaults to "memory" in async and prefork '
+                      'mode and to a new private temporary directory, '
+                      'removed at exit, in classic mode, where "memory" can '
+                      'not be used since every request is served by a new '
+                      'process.')
+        mode_help = ('Serving mode, "classic" for the forking web server, '
+                     '"async" for the asyncio web server or "prefork" for '
+                     'pre-forked asyncio web server workers.')
+        workers_help = 'Number of worker processes in prefork mode.'
+        threads_help = 'Number of request threads in async and prefork mode.'
+        max_requests_help = ('Requests a worker serves before it is replaced '
+                             'in prefork mode, 0 for no limit.')
+        max_body_size_help = ('Max size in bytes of request bodies, larger '
+                              'requests are rejected.')
+        build_static_help = 'Compress and fingerprint static files and exit.'
         description = 'Start flask web server.'
         parser = argparse.ArgumentParser(description=description)
+        parser.add_argument('--mode', type=str, default='classic',
+                            choices=['classic', 'async', 'prefork'],
+                            help=mode_help, required=False)
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help=workers_help, required=False)
+        parser.add_argument('--threads', type=int, default=32,
+                            help=threads_help, required=False)
+        parser.add_argument('--max-requests', type=int, default=0,
+                            help=max_requests_help, required=False)
+        parser.add_argument('--max-body-size', type=int,
+                            default=16 * 1024 * 1024,
+                            help=max_body_size_help, required=False)
+        parser.add_argument('--build-static', action='store_true',
+                            help=build_static_help, required=False)
         parser.add_argument('--debug', type=int, default=0,
                             help=debug_help, required=False)
+        parser.add_argument('--cache', type=str, default=None,
+                            help=cache_help, required=False)
         args = parser.parse_args()
+        if args.cache is None and args.mode != 'classic':
+            args.cache = 'memory'
+        elif args.cache == 'memory' and args.mode == 'classic':
+            parser.error('--cache memory can not be used with --mode '
+                         'classic, every request is served by a new process')
         return args
 
     def run(self):
@@ -81,6 +1699,28 @@ class Main:
         flask_debug = False
         if args.debug > 0:
             flask_debug = True
+        static_assets.build()
+        if args.build_static:
+            return
+        web_server.config['MAX_CONTENT_LENGTH'] = args.max_body_size
+        if args.cache is None:
+            # A new directory only this user can access, a fixed name in the
+            # shared temporary directory could be created by another user
+            args.cache = tempfile.mkdtemp(prefix='flaskserver-cache-')
+            atexit.register(shutil.rmtree, args.cache, True)
+        if args.cache == 'none':
+            response_cache.store = None
+        elif args.cache != 'memory':
+            response_cache.store = DiskCacheStore(args.cache)
+        if args.mode == 'async':
+            AsyncServer(web_server, host='0.0.0.0', port=5000,
+                        threads=args.threads).run()
+            return
+        if args.mode == 'prefork':
+            PreforkServer(web_server, host='0.0.0.0', port=5000,
+                          workers=args.workers, threads=args.threads,
+                          max_requests=args.max_requests).run()
+            return
         web_server.run(debug=flask_debug,
                        host='0.0.0.0',
                        port=5000,
@@ -101,7 +1741,26 @@ def index():
 
     """
     request_handler = RequestHandler()
-    return request_handler.handle_request()
+    return request_metrics.handle(request_handler.handle_request,
+                                  request.url_rule.rule)
+
+
+@web_server.route('/metrics')
+def metrics():
+    """
+    Handle requests for metrics.
+
+    """
+    return Response(request_metrics.render() + response_cache.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+request_metrics = RequestMetrics(
+    [rule.rule for rule in web_server.url_map.iter_rules()])
+
+response_cache = ResponseCache(MemoryCacheStore())
+
+static_assets = StaticAssets(web_server)
 
 
 if __name__ == '__main__':
@@ -9,51 +9,1544 @@ This module handles connections to a log file.
 
 """
 
+import atexit
+import bisect
 import datetime
 import fcntl
+import glob
+import gzip
+import itertools
+import json
+import lzma
+import mmap
+import os
+import queue
+import re
+import shutil
+import selectors
+import socket
+import struct
+import threading
 import time
+import weakref
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
 
 
 class LogFile:
     """Log file container."""
 
-    def __init__(self, file_name, verbosity=0):
+    COMPRESSORS = {'gzip': ('.gz', gzip.open), 'lzma': ('.xz', lzma.open)}
+    """(*dict*) File suffix and open function for each compression."""
+    if zstd is not None:
+        COMPRESSORS['zstd'] = ('.zst', zstd.open)
+
+    ROTATED_NAME_FORMAT = '%Y%m%d-%H%M%S'
+    """(*str*) Date format of the suffix added to rotated log files."""
+
+    CHUNK_SIZE = 1024 * 1024
+    """(*int*) Max number of bytes assembled before they are written."""
+
+    __INSTANCES = weakref.WeakSet()
+    """(*WeakSet*) Log files to reset in forked child processes."""
+
+    def __init__(self, file_name, verbosity=0, batch_size=0,
+                 batch_interval=1.0, rotate_size=0, rotate_interval=0,
+                 rotate_count=5, compress='gzip', record_format=None,
+                 source=None):
         """
         Initializes a LogFile instance.
 
-        :param str file_name: File name and full path to log file.
-        :param int verbosity: Log file verbosity.
+        :param str file_name:        File name and full path to log file.
+        :param int verbosity:        Log file verbosity.
+        :param int batch_size:       Number of bytes to collect in memory
+                                     before they are written to the log file.
+                                     If set to 0 every call to write goes
+                                     straight to disk.
+        :param float batch_interval: Max number of seconds lines are kept in
+                                     memory when batching is enabled.
+        :param int rotate_size:      Rotate the log file when it reaches this
+                                     many bytes. If set to 0 the log file is
+                                     not rotated on size.
+        :param int rotate_interval:  Rotate the log file when a new period of
+                                     this many seconds starts. If set to 0
+                                     the log file is not rotated on time.
+        :param int rotate_count:     Number of rotated log files to keep.
+        :param str compress:         Compression of rotated log files, one of
+                                     the COMPRESSORS keys or None.
+        :param str record_format:    Write structured records instead of text
+                                     lines, one of LogRecords.FORMATS or
+                                     None for text lines.
+        :param str source:           Source stored in structured records.
 
         """
+        if compress is not None and compress not in LogFile.COMPRESSORS:
+            raise LogFileArgumentValueError(
+                arg_name='compress', arg_value=compress,
+                valid_values=list(LogFile.COMPRESSORS.keys()) + [None])
+        if (record_format is not None and
+                record_format not in LogRecords.FORMATS):
+            raise LogFileArgumentValueError(
+                arg_name='record_format', arg_value=record_format,
+                valid_values=LogRecords.FORMATS + [None])
         self._file_name = file_name
         self._verbosity = verbosity
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_start = None
+        self._batch_lock = threading.Condition(threading.Lock())
+        self._flusher = None
+        self._flusher_stop = False
+        self._fd = None
+        self._rotate_size = rotate_size
+        self._rotate_interval = rotate_interval
+        self._rotate_count = rotate_count
+        self._compress = compress
+        self._compress_threads = []
+        self._record_format = record_format
+        self._source = source
+        self._timestamp = (None, b'')
+        LogFile.__INSTANCES.add(self)
+        if self._batch_size > 0:
+            self._start_flusher()
+        if self._batch_size > 0 or self._rotates():
+            atexit.register(self.close)
 
     # noinspection PyTypeChecker
     def write(self, lines, level=0, date_time=True):
         """
         Write message to log file.
 
-        :param list lines:     List of messages.
+        :param lines:          List, or other iterable, of messages.
         :param int level:      Required verbosity level for lines to be added
                                to log file.
         :param bool date_time: If date and time should be added to message.
 
         """
         if self._verbosity >= level:
-            if date_time:
-                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                lines = [now+' '+i for i in lines]
-            lines = [i+'\n' for i in lines]
-            file_obj = open(self._file_name, 'a')
-            fcntl.flock(file_obj, fcntl.LOCK_EX)
-            lock = False
-            for i in range(40):
+            chunks = self._encode_chunks(lines, level, date_time)
+            if self._batch_size > 0:
+                for chunk, _ in chunks:
+                    self._add_to_batch(chunk)
+                return
+            if self._rotates():
+                with self._batch_lock:
+                    for chunk, _ in chunks:
+                        self._write_data(chunk)
+                return
+            fd = os.open(self._file_name,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                for chunk, _ in chunks:
+                    self._write_all(fd, chunk)
+            finally:
+                os.close(fd)
+
+    def flush(self):
+        """
+        Write all lines collected in memory to the log file.
+
+        """
+        with self._batch_lock:
+            self._flush_batch()
+
+    def close(self):
+        """
+        Flush collected lines and close the log file descriptor.
+
+        Waits for compression of rotated log files to finish.
+
+        """
+        with self._batch_lock:
+            self._flusher_stop = True
+            self._batch_lock.notify_all()
+            self._flush_batch()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            threads = self._compress_threads
+            self._compress_threads = []
+            flusher = self._flusher
+            self._flusher = None
+        if flusher is not None and flusher is not threading.current_thread():
+            flusher.join()
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def rotated_files(file_name):
+        """
+        Get rotated log files of a log file, oldest first.
+
+        :param str file_name: File name and full path to log file.
+        :rtype:   list
+        :returns: Full paths to rotated log files.
+
+        """
+        regex = re.compile(
+            r'\A{}\.\d{{8}}-\d{{6}}(-\d+)?(\.\w+)?\Z'.format(
+                re.escape(os.path.basename(file_name))))
+        files = [i for i in glob.glob(glob.escape(file_name) + '.*')
+                 if regex.match(os.path.basename(i))]
+        return sorted(files, key=lambda i: [
+            int(j) for j in re.findall(r'\d+', i[len(file_name):])])
+
+    def _timestamp_prefix(self):
+        """
+        Get the date and time prefix for log lines.
+
+        The prefix is only formatted again when the second changes.
+
+        :rtype:   bytes
+        :returns: Encoded date and time followed by a space.
+
+        """
+        second = int(time.time())
+        cached_second, prefix = self._timestamp
+        if second != cached_second:
+            prefix = time.strftime('%Y-%m-%d %H:%M:%S ',
+                                   time.localtime(second)).encode('ascii')
+            self._timestamp = (second, prefix)
+        return prefix
+
+    def _encode_chunks(self, lines, level, date_time):
+        """
+        Encode messages as text lines or structured records.
+
+        Messages are assembled in a buffer which is returned when it reaches
+        CHUNK_SIZE, so large iterables of messages are never held in memory
+        as a whole.
+
+        :param lines:          Iterable of messages.
+        :param int level:      Verbosity level of the messages.
+        :param bool date_time: If date and time should be added to message.
+        :rtype:   generator
+        :returns: Data to write to the log file and its number of messages.
+
+        """
+        if self._record_format is not None:
+            epoch = int(time.time()) if date_time else None
+            lines = iter(lines)
+            while True:
+                batch = list(itertools.islice(lines, 1000))
+                if len(batch) == 0:
+                    return
+                yield (LogRecords.encode(
+                    [(epoch, level, self._source, i) for i in batch],
+                    self._record_format), len(batch))
+        prefix = self._timestamp_prefix() if date_time else b''
+        chunk = bytearray()
+        count = 0
+        for line in lines:
+            chunk += prefix
+            chunk += line.encode('utf-8')
+            chunk += b'\n'
+            count += 1
+            if len(chunk) >= LogFile.CHUNK_SIZE:
+                yield chunk, count
+                chunk = bytearray()
+                count = 0
+        if count > 0:
+            yield chunk, count
+
+    def _add_to_batch(self, data):
+        """
+        Add lines to the in memory batch and flush it if it is full or old.
+
+        :param bytes data: Encoded lines, ending with newline.
+
+        """
+        with self._batch_lock:
+            if self._batch_start is None:
+                self._batch_start = time.monotonic()
+                self._batch_lock.notify_all()
+            self._batch.append(data)
+            self._batch_bytes += len(data)
+            if (self._batch_bytes >= self._batch_size or
+                    time.monotonic() - self._batch_start >=
+                    self._batch_interval):
+                self._flush_batch()
+
+    def _flush_batch(self):
+        """
+        Write the in memory batch to the log file.
+
+        ..note:
+
+            The batch lock must be held by the caller.
+
+        """
+        if self._batch_bytes == 0:
+            return
+        data = b''.join(self._batch)
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_start = None
+        self._write_data(data)
+
+    def _start_flusher(self):
+        """
+        Start the thread that writes batches older than batch_interval.
+
+        """
+        self._flusher = threading.Thread(target=self._flush_timer,
+                                         daemon=True)
+        self._flusher.start()
+
+    def _flush_timer(self):
+        """
+        Flusher thread, writes the batch when it gets older than
+        batch_interval, also when nothing more is written.
+
+        """
+        with self._batch_lock:
+            while not self._flusher_stop:
+                if self._batch_start is None:
+                    self._batch_lock.wait()
+                    continue
+                remaining = (self._batch_start + self._batch_interval -
+                             time.monotonic())
+                if remaining > 0:
+                    self._batch_lock.wait(remaining)
+                    continue
+                self._flush_batch()
+
+    @staticmethod
+    def _after_fork_in_child():
+        """
+        Reset all log files in a forked child process.
+
+        """
+        for log_file in list(LogFile.__INSTANCES):
+            log_file._after_fork()
+
+    def _after_fork(self):
+        """
+        Reset state inherited from the parent process after a fork.
+
+        Lines collected in memory are left for the parent to write, and the
+        inherited file descriptor is closed since a lock taken on it would
+        be shared with the parent. Threads don't survive a fork, so the
+        flusher is started again.
+
+        """
+        running = self._flusher is not None
+        self._batch_lock = threading.Condition(threading.Lock())
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_start = None
+        self._flusher = None
+        self._compress_threads = []
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if running:
+            self._start_flusher()
+
+    def _write_data(self, data):
+        """
+        Append data to the log file with a single write.
+
+        The log file is opened with O_APPEND and kept open between calls.
+        An exclusive lock is held during the write so that other processes
+        using the same log file don't interleave with the batch.
+
+        :param bytes data: Data to write.
+
+        """
+        self._lock_fd()
+        try:
+            if self._rotates() and self._rotation_due():
+                self._rotate()
+            self._write_all(self._fd, data)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write_all(fd, data):
+        """
+        Write data to a file descriptor, normally with a single system call.
+
+        :param int fd:     File descriptor.
+        :param bytes data: Data to write.
+
+        """
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(fd, view):]
+
+    def _lock_fd(self):
+        """
+        Open the log file if needed and take an exclusive lock on it.
+
+        If another process has rotated the log file while we waited for the
+        lock, the new log file is opened and locked instead.
+
+        """
+        while True:
+            if self._fd is None:
+                self._fd = os.open(
+                    self._file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                    0o666)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            if not self._rotates():
+                return
+            try:
+                if os.stat(self._file_name).st_ino == os.fstat(
+                        self._fd).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def _rotates(self):
+        """
+        Check if log rotation is enabled.
+
+        :rtype: bool
+
+        """
+        return self._rotate_size > 0 or self._rotate_interval > 0
+
+    def _rotation_due(self):
+        """
+        Check if the locked log file should be rotated before writing.
+
+        :rtype: bool
+
+        """
+        stat = os.fstat(self._fd)
+        if stat.st_size == 0:
+            return False
+        if 0 < self._rotate_size <= stat.st_size:
+            return True
+        if self._rotate_interval > 0:
+            return (stat.st_mtime // self._rotate_interval !=
+                    time.time() // self._rotate_interval)
+        return False
+
+    def _rotate(self):
+        """
+        Rotate the locked log file and start compressing it.
+
+        The log file is renamed while we hold the lock, and a new locked log
+        file replaces it. Compression and removal of old log files run in a
+        background thread.
+
+        """
+        rotated_name = '{}.{}'.format(
+            self._file_name,
+            datetime.datetime.now().strftime(LogFile.ROTATED_NAME_FORMAT))
+        name, i = rotated_name, 0
+        while glob.glob(glob.escape(name) + '*'):
+            i += 1
+            name = '{}-{}'.format(rotated_name, i)
+        os.rename(self._file_name, name)
+        old_fd = self._fd
+        self._fd = None
+        self._lock_fd()
+        fcntl.flock(old_fd, fcntl.LOCK_UN)
+        os.close(old_fd)
+        self._compress_threads = [
+            i for i in self._compress_threads if i.is_alive()]
+        thread = threading.Thread(target=self._compress_rotated,
+                                  args=(name,), daemon=True)
+        thread.start()
+        self._compress_threads.append(thread)
+
+    def _compress_rotated(self, rotated_name):
+        """
+        Compress a rotated log file and remove the oldest rotated log files.
+
+        :param str rotated_name: Full path to the rotated log file.
+
+        """
+        if self._compress is not None:
+            suffix, open_function = LogFile.COMPRESSORS[self._compress]
+            try:
+                with open(rotated_name, 'rb') as src, \
+                        open_function(rotated_name+suffix+'~', 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.rename(rotated_name+suffix+'~', rotated_name+suffix)
+                os.unlink(rotated_name)
+            except FileNotFoundError:
+                pass
+        rotated_files = LogFile.rotated_files(self._file_name)
+        for old_file in rotated_files[:-self._rotate_count or None]:
+            try:
+                os.unlink(old_file)
+            except FileNotFoundError:
+                pass
+
+
+os.register_at_fork(after_in_child=LogFile._after_fork_in_child)
+
+
+class AsyncLogFile(LogFile):
+    """
+    Log file container that writes to disk from a background thread.
+
+    Calls to write only put lines on a bounded queue. A writer thread drains
+    the queue and appends everything that is queued with a single write.
+
+    """
+
+    OVERFLOW_POLICIES = ['block', 'drop_oldest', 'drop_newest']
+    """(*list*) Valid policies for when the queue is full."""
+
+    __STOP = object()
+    """(*object*) Queue item that stops the writer thread."""
+
+    def __init__(self, file_name, verbosity=0, queue_size=10000,
+                 overflow='block', **kwargs):
+        """
+        Initializes an AsyncLogFile instance.
+
+        :param str file_name:  File name and full path to log file.
+        :param int verbosity:  Log file verbosity.
+        :param int queue_size: Max number of write calls waiting in the queue.
+        :param str overflow:   What to do when the queue is full, one of
+                               'block', 'drop_oldest' or 'drop_newest'.
+        :param kwargs:         Other arguments, see LogFile.
+
+        """
+        if overflow not in AsyncLogFile.OVERFLOW_POLICIES:
+            raise LogFileArgumentValueError(
+                arg_name='overflow', arg_value=overflow,
+                valid_values=AsyncLogFile.OVERFLOW_POLICIES)
+        super().__init__(file_name, verbosity, **kwargs)
+        self._overflow = overflow
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._counter_lock = threading.Lock()
+        self._queued = 0
+        self._dropped = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @property
+    def queued(self):
+        """
+        (*int*) Number of lines currently waiting to be written.
+
+        """
+        return self._queued
+
+    @property
+    def dropped(self):
+        """
+        (*int*) Number of lines dropped because the queue was full.
+
+        """
+        return self._dropped
+
+    # noinspection PyTypeChecker
+    def write(self, lines, level=0, date_time=True):
+        """
+        Queue message for writing to log file.
+
+        :param lines:          List, or other iterable, of messages.
+        :param int level:      Required verbosity level for lines to be added
+                               to log file.
+        :param bool date_time: If date and time should be added to message.
+
+        """
+        if self._verbosity >= level and not self._closed:
+            for chunk, count in self._encode_chunks(lines, level, date_time):
+                self._put((bytes(chunk), count))
+
+    def flush(self):
+        """
+        Wait until all queued lines have been written to the log file.
+
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Write all queued lines, stop the writer thread and close the log file.
+
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(AsyncLogFile.__STOP)
+        self._thread.join()
+        super().close()
+
+    def _after_fork(self):
+        """
+        Reset state inherited from the parent process after a fork.
+
+        The writer thread doesn't survive a fork, so the child gets an empty
+        queue and a new writer thread. Lines queued before the fork are
+        written by the parent.
+
+        """
+        super()._after_fork()
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._counter_lock = threading.Lock()
+        self._queued = 0
+        self._dropped = 0
+        if not self._closed:
+            self._thread = threading.Thread(target=self._writer, daemon=True)
+            self._thread.start()
+
+    def _put(self, item):
+        """
+        Put item on the queue according to the overflow policy.
+
+        :param tuple item: Data and number of lines.
+
+        """
+        with self._counter_lock:
+            self._queued += item[1]
+        if self._overflow == 'block':
+            self._queue.put(item)
+            return
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                if self._overflow == 'drop_newest':
+                    self._count_written(item[1], dropped=True)
+                    return
+            # Drop oldest
+            try:
+                oldest = self._queue.get_nowait()
+            except queue.Empty:
+                continue
+            self._queue.task_done()
+            if oldest is AsyncLogFile.__STOP:
+                self._queue.put(oldest)
+                return
+            self._count_written(oldest[1], dropped=True)
+
+    def _count_written(self, lines, dropped=False):
+        """
+        Update counters when lines leave the queue.
+
+        :param int lines:    Number of lines.
+        :param bool dropped: If the lines were dropped instead of written.
+
+        """
+        with self._counter_lock:
+            self._queued -= lines
+            if dropped:
+                self._dropped += lines
+
+    def _writer(self):
+        """
+        Writer thread, drains the queue to the log file.
+
+        """
+        while True:
+            items = [self._queue.get()]
+            while items[-1] is not AsyncLogFile.__STOP:
                 try:
-                    fcntl.flock(file_obj, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    lock = True
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
                     break
-                except IOError:
-                    time.sleep(0.05)
-            if lock:
-                file_obj.writelines(lines)
+            stop = items[-1] is AsyncLogFile.__STOP
+            if stop:
+                items.pop()
+            try:
+                if len(items) > 0:
+                    self._write_data(b''.join(i[0] for i in items))
+            finally:
+                self._count_written(sum(i[1] for i in items))
+                for _ in range(len(items) + stop):
+                    self._queue.task_done()
+            if stop:
+                return
+
+
+class AggregatedLogFile(LogFile):
+    """
+    Log file container that sends lines to a LogAggregator.
+
+    Lines are sent over a Unix domain socket to a LogAggregator process which
+    is the only writer of the log file.
+
+    """
+
+    def __init__(self, socket_path, verbosity=0, batch_size=0,
+                 batch_interval=1.0, fallback_file_name=None):
+        """
+        Initializes an AggregatedLogFile instance.
+
+        :param str socket_path:        Path to the LogAggregator socket.
+        :param int verbosity:          Log file verbosity.
+        :param int batch_size:         Number of bytes to collect in memory
+                                       before they are sent to the
+                                       aggregator. If set to 0 every call to
+                                       write is sent directly.
+        :param float batch_interval:   Max number of seconds lines are kept in
+                                       memory when batching is enabled.
+        :param str fallback_file_name: Log file to write to directly if the
+                                       aggregator can't be reached.
+
+        """
+        super().__init__(fallback_file_name, verbosity, batch_size,
+                         batch_interval)
+        self._socket_path = socket_path
+        self._socket = None
+        self._socket_pid = None
+
+    # noinspection PyTypeChecker
+    def write(self, lines, level=0, date_time=True):
+        """
+        Send message to the log aggregator.
+
+        :param lines:          List, or other iterable, of messages.
+        :param int level:      Required verbosity level for lines to be added
+                               to log file.
+        :param bool date_time: If date and time should be added to message.
+
+        """
+        if self._verbosity >= level:
+            for chunk, _ in self._encode_chunks(lines, level, date_time):
+                if self._batch_size > 0:
+                    self._add_to_batch(chunk)
+                else:
+                    with self._batch_lock:
+                        self._write_data(chunk)
+
+    def close(self):
+        """
+        Send collected lines and close the connection to the aggregator.
+
+        """
+        super().close()
+        with self._batch_lock:
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+
+    def _write_data(self, data):
+        """
+        Send data to the aggregator as one frame.
+
+        The connection is reopened once if it has been closed, or if the
+        process has been forked since it was opened. If the aggregator can't
+        be reached the data is written to the fallback log file.
+
+        :param bytes data: Data to send.
+
+        """
+        frame = struct.pack(LogAggregator.FRAME_HEADER, len(data)) + data
+        for _ in range(2):
+            try:
+                if self._socket is None or self._socket_pid != os.getpid():
+                    self._connect()
+                self._socket.sendall(frame)
+                return
+            except OSError:
+                if self._socket is not None:
+                    self._socket.close()
+                self._socket = None
+        if self._file_name is not None:
+            super()._write_data(data)
+
+    def _connect(self):
+        """
+        Connect to the aggregator socket.
+
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self._socket = sock
+        self._socket_pid = os.getpid()
+
+
+class LogAggregator:
+    """
+    Collector that writes lines from many processes to one log file.
+
+    The aggregator listens on a Unix domain socket. Each AggregatedLogFile
+    client sends frames consisting of a length header followed by complete
+    lines. Frames are appended to the log file in batches, so only one
+    process ever writes to it.
+
+    Example of starting the aggregator in its own process::
+
+        aggregator = LogAggregator('/tmp/log.sock', '/var/log/app.log')
+        multiprocessing.Process(target=aggregator.run, daemon=True).start()
+
+    """
+
+    FRAME_HEADER = '!I'
+    """(*str*) Struct format of the frame length header."""
+
+    def __init__(self, socket_path, file_name, batch_size=65536,
+                 batch_interval=1.0, **rotation):
+        """
+        Initializes a LogAggregator instance.
+
+        :param str socket_path:      Path of the Unix domain socket to listen
+                                     on.
+        :param str file_name:        File name and full path to log file.
+        :param int batch_size:       Number of bytes to collect in memory
+                                     before they are written to the log file.
+        :param float batch_interval: Max number of seconds lines are kept in
+                                     memory.
+        :param rotation:             Log rotation arguments, see LogFile.
+
+        """
+        self._socket_path = socket_path
+        self._log_file = LogFile(file_name, batch_size=max(batch_size, 1),
+                                 batch_interval=batch_interval, **rotation)
+        self._batch_interval = batch_interval
+        self._running = False
+
+    def run(self):
+        """
+        Listen for clients and write their lines until stop is called.
+
+        """
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        server.listen(socket.SOMAXCONN)
+        server.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        self._running = True
+        try:
+            while self._running:
+                events = selector.select(timeout=self._batch_interval)
+                for key, _ in events:
+                    if key.fileobj is server:
+                        self._accept(server, selector)
+                    else:
+                        self._read(key.fileobj, key.data, selector)
+                if len(events) == 0:
+                    self._log_file.flush()
+        finally:
+            for key in list(selector.get_map().values()):
+                selector.unregister(key.fileobj)
+                if key.data is not None:
+                    self._read_frames(key.data)
+                key.fileobj.close()
+            selector.close()
+            os.unlink(self._socket_path)
+            self._log_file.close()
+
+    def stop(self):
+        """
+        Stop the aggregator, it exits within one batch interval.
+
+        """
+        self._running = False
+
+    @staticmethod
+    def _accept(server, selector):
+        """
+        Accept a new client connection.
+
+        :param socket server:                 Listening socket.
+        :param selectors.BaseSelector selector: Selector to register client in.
+
+        """
+        try:
+            client, _ = server.accept()
+        except BlockingIOError:
+            return
+        client.setblocking(False)
+        selector.register(client, selectors.EVENT_READ, bytearray())
+
+    def _read(self, client, buffer, selector):
+        """
+        Read data from a client and write all complete frames.
+
+        :param socket client:                   Client socket.
+        :param bytearray buffer:                Data received from the client
+                                                that is not yet written.
+        :param selectors.BaseSelector selector: Selector the client is
+                                                registered in.
+
+        """
+        try:
+            data = client.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if len(data) == 0:
+            selector.unregister(client)
+            client.close()
+            return
+        buffer += data
+        self._read_frames(buffer)
+
+    def _read_frames(self, buffer):
+        """
+        Write all complete frames in a client buffer to the log file.
+
+        :param bytearray buffer: Data received from a client.
+
+        """
+        header_size = struct.calcsize(LogAggregator.FRAME_HEADER)
+        offset = 0
+        while len(buffer) - offset >= header_size:
+            size = struct.unpack_from(LogAggregator.FRAME_HEADER, buffer,
+                                      offset)[0]
+            if len(buffer) - offset - header_size < size:
+                break
+            start = offset + header_size
+            self._log_file._add_to_batch(bytes(buffer[start:start+size]))
+            offset = start + size
+        del buffer[:offset]
+
+
+class LogReader:
+    """
+    Reader for log files written by LogFile.
+
+    Lines start with a "%Y-%m-%d %H:%M:%S" timestamp, which sorts the same
+    way as bytes as it does as time. Uncompressed log files are memory
+    mapped and searched with binary search on the timestamp, so a time range
+    query only reads the lines it returns. Rotated log files are included,
+    and compressed ones are skipped entirely if they are outside the range.
+
+    """
+
+    TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+    """(*str*) Format of the timestamp at the start of log lines."""
+
+    __TIMESTAMP_REGEX = re.compile(
+        rb'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d ')
+    """(*re.Pattern*) Matches a timestamp at the start of a line."""
+
+    __TIMESTAMP_SIZE = 19
+    """(*int*) Number of bytes in a timestamp."""
+
+    __INDEX_HEADER = '!QQ'
+    """(*str*) Struct format of the index header, inode and indexed size."""
+
+    __INDEX_ENTRY = '!19sQ'
+    """(*str*) Struct format of an index entry, timestamp and offset."""
+
+    def __init__(self, file_name, index=False, index_interval=1024 * 1024):
+        """
+        Initializes a LogReader instance.
+
+        :param str file_name:      File name and full path to log file.
+        :param bool index:         If a sparse index of the log file should
+                                   be kept in a sidecar file.
+        :param int index_interval: Number of bytes between index entries.
+
+        """
+        self._file_name = file_name
+        self._index = index
+        self._index_interval = index_interval
+        self._index_file_name = os.path.join(
+            os.path.dirname(file_name),
+            '.{}.idx'.format(os.path.basename(file_name)))
+
+    def segments(self):
+        """
+        Get rotated log files and the log file, oldest first.
+
+        :rtype:   list
+        :returns: Full paths to log files.
+
+        """
+        segments = LogFile.rotated_files(self._file_name)
+        if os.path.isfile(self._file_name):
+            segments.append(self._file_name)
+        return segments
+
+    def read(self, start=None, end=None, pattern=None):
+        """
+        Read log lines in a time range.
+
+        Lines without a timestamp are returned together with the timestamped
+        line they follow.
+
+        :param start:       Start of the time range, a datetime or a string
+                            in TIMESTAMP_FORMAT. If None read from the
+                            first line.
+        :param end:         End of the time range, inclusive. If None read to
+                            the last line.
+        :param str pattern: Only return lines matching this regular
+                            expression.
+        :rtype:   generator
+        :returns: Log lines without newline.
+
+        """
+        start = self._timestamp(start)
+        end = self._timestamp(end)
+        regex = re.compile(pattern) if pattern is not None else None
+        for segment in self.segments():
+            if start is not None and segment != self._file_name:
+                rotated = self._segment_end(segment)
+                if rotated is not None and rotated < start:
+                    continue
+            if segment == self._file_name or not self._compressed(segment):
+                lines = self._read_mapped(segment, start, end)
+            else:
+                lines = self._read_compressed(segment, start, end)
+            for line in lines:
+                if regex is None or regex.search(line):
+                    yield line
+
+    def follow(self, from_end=True, pattern=None, poll_interval=0.5):
+        """
+        Follow the log file like "tail -f".
+
+        Rotation and truncation of the log file is detected and the new log
+        file is followed from its start.
+
+        :param bool from_end:       If only lines written after the call
+                                    should be returned.
+        :param str pattern:         Only return lines matching this regular
+                                    expression.
+        :param float poll_interval: Seconds to wait between checks for new
+                                    lines.
+        :rtype:   generator
+        :returns: Log lines without newline.
+
+        """
+        regex = re.compile(pattern) if pattern is not None else None
+        file_obj = None
+        inode = None
+        pending = b''
+        try:
+            while True:
+                if file_obj is None:
+                    try:
+                        file_obj = open(self._file_name, 'rb')
+                    except FileNotFoundError:
+                        time.sleep(poll_interval)
+                        continue
+                    inode = os.fstat(file_obj.fileno()).st_ino
+                    if from_end:
+                        file_obj.seek(0, os.SEEK_END)
+                    from_end = False
+                data = file_obj.read(LogFile.CHUNK_SIZE)
+                if len(data) > 0:
+                    lines = (pending + data).split(b'\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        line = line.decode('utf-8', 'replace')
+                        if regex is None or regex.search(line):
+                            yield line
+                    continue
+                try:
+                    stat = os.stat(self._file_name)
+                except FileNotFoundError:
+                    stat = None
+                if stat is None or stat.st_ino != inode:
+                    file_obj.close()
+                    file_obj = None
+                    pending = b''
+                    continue
+                if stat.st_size < file_obj.tell():
+                    file_obj.seek(0)
+                    pending = b''
+                    continue
+                time.sleep(poll_interval)
+        finally:
+            if file_obj is not None:
                 file_obj.close()
+
+    def update_index(self):
+        """
+        Add index entries for lines written since the index was last updated.
+
+        The index is rebuilt if the log file has been rotated.
+
+        """
+        try:
+            with open(self._file_name, 'rb') as file_obj:
+                stat = os.fstat(file_obj.fileno())
+                if stat.st_size == 0:
+                    return
+                with mmap.mmap(file_obj.fileno(), 0,
+                               access=mmap.ACCESS_READ) as mapped:
+                    self._update_index(mapped, stat.st_ino)
+        except FileNotFoundError:
+            pass
+
+    def _update_index(self, mapped, inode):
+        """
+        Update the index of a memory mapped log file.
+
+        :param mmap.mmap mapped: Memory mapped log file.
+        :param int inode:        Inode of the log file.
+        :rtype:   list
+        :returns: Index entries, timestamp and offset.
+
+        """
+        indexed_inode, indexed_size, entries = self._load_index()
+        if indexed_inode != inode or indexed_size > len(mapped):
+            indexed_size, entries = 0, []
+        size = mapped.rfind(b'\n') + 1
+        if size <= indexed_size:
+            return entries
+        offset = indexed_size
+        if len(entries) > 0:
+            offset = entries[-1][1] + self._index_interval
+        while offset < size:
+            line_start = self._line_start(mapped, offset, size)
+            timestamp, line_start = self._next_timestamp(
+                mapped, line_start, size)
+            if timestamp is None:
+                break
+            entries.append((timestamp, line_start))
+            offset = line_start + self._index_interval
+        header = struct.pack(LogReader.__INDEX_HEADER, inode, size)
+        data = b''.join(struct.pack(LogReader.__INDEX_ENTRY, *i)
+                        for i in entries)
+        with open(self._index_file_name+'~', 'wb') as file_obj:
+            file_obj.write(header + data)
+        os.rename(self._index_file_name+'~', self._index_file_name)
+        return entries
+
+    def _load_index(self):
+        """
+        Load the sidecar index.
+
+        :rtype:   tuple
+        :returns: Inode and indexed size of the log file, and index entries.
+
+        """
+        try:
+            with open(self._index_file_name, 'rb') as file_obj:
+                data = file_obj.read()
+        except FileNotFoundError:
+            return None, 0, []
+        header_size = struct.calcsize(LogReader.__INDEX_HEADER)
+        entry_size = struct.calcsize(LogReader.__INDEX_ENTRY)
+        if len(data) < header_size:
+            return None, 0, []
+        inode, size = struct.unpack_from(LogReader.__INDEX_HEADER, data)
+        end = header_size + (len(data) - header_size) // entry_size * (
+            entry_size)
+        entries = list(struct.iter_unpack(LogReader.__INDEX_ENTRY,
+                                          data[header_size:end]))
+        return inode, size, entries
+
+    def _read_mapped(self, file_name, start, end):
+        """
+        Read lines in a time range from an uncompressed log file.
+
+        :param str file_name: Full path to log file.
+        :param bytes start:   Start timestamp or None.
+        :param bytes end:     End timestamp or None.
+        :rtype:   generator
+        :returns: Log lines without newline.
+
+        """
+        try:
+            file_obj = open(file_name, 'rb')
+        except FileNotFoundError:
+            return
+        with file_obj:
+            stat = os.fstat(file_obj.fileno())
+            if stat.st_size == 0:
+                return
+            with mmap.mmap(file_obj.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                size = mapped.rfind(b'\n') + 1
+                low, high = 0, size
+                if start is not None:
+                    if self._index and file_name == self._file_name:
+                        entries = self._update_index(mapped, stat.st_ino)
+                        i = bisect.bisect_left(entries, (start, 0))
+                        if i > 0:
+                            low = entries[i-1][1]
+                        if i < len(entries):
+                            high = entries[i][1]
+                    low = self._search(mapped, start, low, high, size)
+                offset = low
+                while offset < size:
+                    line_end = mapped.find(b'\n', offset, size)
+                    if end is not None and self._has_timestamp(
+                            mapped, offset, line_end):
+                        if (mapped[offset:offset+LogReader.__TIMESTAMP_SIZE]
+                                > end):
+                            return
+                    yield mapped[offset:line_end].decode('utf-8', 'replace')
+                    offset = line_end + 1
+
+    def _read_compressed(self, file_name, start, end):
+        """
+        Read lines in a time range from a compressed log file.
+
+        :param str file_name: Full path to log file.
+        :param bytes start:   Start timestamp or None.
+        :param bytes end:     End timestamp or None.
+        :rtype:   generator
+        :returns: Log lines without newline.
+
+        """
+        open_function = self._compressed(file_name)
+        started = start is None
+        try:
+            file_obj = open_function(file_name, 'rb')
+        except FileNotFoundError:
+            return
+        with file_obj:
+            for line in file_obj:
+                if LogReader.__TIMESTAMP_REGEX.match(line):
+                    timestamp = line[:LogReader.__TIMESTAMP_SIZE]
+                    if end is not None and timestamp > end:
+                        return
+                    if not started:
+                        started = timestamp >= start
+                if started:
+                    yield line.rstrip(b'\n').decode('utf-8', 'replace')
+
+    def _search(self, mapped, timestamp, low, high, size):
+        """
+        Binary search for the first line with a timestamp not before a
+        timestamp.
+
+        :param mmap.mmap mapped: Memory mapped log file.
+        :param bytes timestamp:  Timestamp to search for.
+        :param int low:          Line start offset to search from.
+        :param int high:         Offset to search to.
+        :param int size:         Size of the complete lines in the log file.
+        :rtype:   int
+        :returns: Line start offset of the timestamped line, or size if
+                  there is none.
+
+        """
+        while low < high:
+            middle = (low + high) // 2
+            line_start = self._line_start(mapped, middle, size)
+            found, _ = self._next_timestamp(mapped, line_start, size)
+            if found is None or found >= timestamp:
+                high = middle
+            else:
+                low = middle + 1
+        line_start = self._line_start(mapped, low, size)
+        return self._next_timestamp(mapped, line_start, size)[1]
+
+    def _next_timestamp(self, mapped, offset, size):
+        """
+        Find the first timestamped line at or after a line start offset.
+
+        :param mmap.mmap mapped: Memory mapped log file.
+        :param int offset:       Line start offset.
+        :param int size:         Size of the complete lines in the log file.
+        :rtype:   tuple
+        :returns: Timestamp and line start offset, or None and size.
+
+        """
+        while offset < size:
+            line_end = mapped.find(b'\n', offset, size)
+            if self._has_timestamp(mapped, offset, line_end):
+                return (mapped[offset:offset+LogReader.__TIMESTAMP_SIZE],
+                        offset)
+            offset = line_end + 1
+        return None, size
+
+    @staticmethod
+    def _has_timestamp(mapped, offset, line_end):
+        """
+        Check if a line starts with a timestamp.
+
+        :param mmap.mmap mapped: Memory mapped log file.
+        :param int offset:       Line start offset.
+        :param int line_end:     Line end offset.
+        :rtype: bool
+
+        """
+        return LogReader.__TIMESTAMP_REGEX.match(
+            mapped, offset, line_end) is not None
+
+    @staticmethod
+    def _line_start(mapped, offset, size):
+        """
+        Get the first line start at or after an offset.
+
+        :param mmap.mmap mapped: Memory mapped log file.
+        :param int offset:       Offset.
+        :param int size:         Size of the complete lines in the log file.
+        :rtype: int
+
+        """
+        if offset == 0 or mapped[offset-1] == ord('\n'):
+            return offset
+        line_end = mapped.find(b'\n', offset, size)
+        return size if line_end < 0 else line_end + 1
+
+    @staticmethod
+    def _timestamp(value):
+        """
+        Convert a time to a timestamp comparable with log lines.
+
+        :param value: A datetime, a string in TIMESTAMP_FORMAT or None.
+        :rtype: bytes
+
+        """
+        if value is None:
+            return None
+        if isinstance(value, datetime.datetime):
+            value = value.strftime(LogReader.TIMESTAMP_FORMAT)
+        return value.encode('ascii')
+
+    def _segment_end(self, segment):
+        """
+        Get the time a rotated log file was rotated.
+
+        :param str segment: Full path to rotated log file.
+        :rtype:   bytes
+        :returns: Timestamp, or None if it can't be found.
+
+        """
+        match = re.match(r'\.(\d{8}-\d{6})',
+                         segment[len(self._file_name):])
+        if match is None:
+            return None
+        rotated = datetime.datetime.strptime(match.group(1),
+                                             LogFile.ROTATED_NAME_FORMAT)
+        return self._timestamp(rotated)
+
+    @staticmethod
+    def _compressed(file_name):
+        """
+        Get the open function for a compressed log file.
+
+        :param str file_name: Full path to log file.
+        :rtype:   function
+        :returns: Open function, or None if the file is not compressed.
+
+        """
+        for suffix, open_function in LogFile.COMPRESSORS.values():
+            if file_name.endswith(suffix):
+                return open_function
+        return None
+
+
+class LogRecords:
+    """
+    Encoding and decoding of structured log records.
+
+    A record is a tuple of epoch time in seconds (or None), level, source (or
+    None) and message. Records are stored in one of two formats:
+
+    * 'ndjson': One JSON object per line with the keys t, l, s and m.
+    * 'binary': A RECORD_HEADER with the size of the source and message,
+      time, level and size of the source, followed by the UTF-8 encoded
+      source and message.
+
+    """
+
+    FORMATS = ['ndjson', 'binary']
+    """(*list*) Supported record formats."""
+
+    RECORD_HEADER = '!IqiH'
+    """(*str*) Struct format of the binary record header."""
+
+    __NO_TIME = -1
+    """(*int*) Binary record time when the record has no time."""
+
+    @staticmethod
+    def encode(records, record_format):
+        """
+        Encode records.
+
+        :param list records:      Records to encode.
+        :param str record_format: Record format.
+        :rtype: bytes
+
+        """
+        if record_format == 'ndjson':
+            dumps = json.JSONEncoder(ensure_ascii=False,
+                                     separators=(',', ':')).encode
+            return ''.join(
+                dumps({'t': i[0], 'l': i[1], 's': i[2], 'm': i[3]}) + '\n'
+                for i in records).encode('utf-8')
+        data = bytearray()
+        for epoch, level, source, message in records:
+            source = b'' if source is None else source.encode('utf-8')
+            message = message.encode('utf-8')
+            data += struct.pack(
+                LogRecords.RECORD_HEADER, len(source) + len(message),
+                LogRecords.__NO_TIME if epoch is None else epoch, level,
+                len(source))
+            data += source
+            data += message
+        return bytes(data)
+
+    @staticmethod
+    def decode(file_obj, record_format):
+        """
+        Decode records from a binary file object.
+
+        :param file_obj:          File object opened in binary mode.
+        :param str record_format: Record format.
+        :rtype:   generator
+        :returns: Records.
+
+        """
+        if record_format == 'ndjson':
+            loads = json.JSONDecoder().decode
+            for line in file_obj:
+                if len(line.strip()) == 0:
+                    continue
+                record = loads(line.decode('utf-8'))
+                yield record['t'], record['l'], record['s'], record['m']
+            return
+        header_size = struct.calcsize(LogRecords.RECORD_HEADER)
+        unpack = struct.Struct(LogRecords.RECORD_HEADER).unpack_from
+        buffer = bytearray()
+        offset = 0
+        while True:
+            data = file_obj.read(1024 * 1024)
+            if len(data) == 0:
+                return
+            del buffer[:offset]
+            buffer += data
+            offset = 0
+            while len(buffer) - offset >= header_size:
+                size, epoch, level, source_size = unpack(buffer, offset)
+                start = offset + header_size
+                if len(buffer) - start < size:
+                    break
+                source = None
+                if source_size > 0:
+                    source = buffer[start:start+source_size].decode('utf-8')
+                message = buffer[start+source_size:start+size].decode(
+                    'utf-8')
+                offset = start + size
+                if epoch == LogRecords.__NO_TIME:
+                    epoch = None
+                yield epoch, level, source, message
+
+    @staticmethod
+    def to_text(records):
+        """
+        Convert records to text lines in the LogFile text format.
+
+        :param records: Iterable of records.
+        :rtype:   generator
+        :returns: Text lines without newline.
+
+        """
+        cached_epoch, cached_prefix = None, ''
+        for epoch, _, _, message in records:
+            if epoch is None:
+                yield message
+                continue
+            if epoch != cached_epoch:
+                cached_epoch = epoch
+                cached_prefix = time.strftime(
+                    '%Y-%m-%d %H:%M:%S ', time.localtime(epoch))
+            yield cached_prefix + message
+
+    @staticmethod
+    def from_text(lines, level=0, source=None):
+        """
+        Convert text lines in the LogFile text format to records.
+
+        :param lines:      Iterable of text lines.
+        :param int level:  Level to set in the records.
+        :param str source: Source to set in the records.
+        :rtype:   generator
+        :returns: Records.
+
+        """
+        regex = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d ')
+        cached_prefix, cached_epoch = None, None
+        for line in lines:
+            line = line.rstrip('\n')
+            if regex.match(line) is None:
+                yield None, level, source, line
+                continue
+            prefix = line[:19]
+            if prefix != cached_prefix:
+                cached_prefix = prefix
+                cached_epoch = int(time.mktime((
+                    int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]),
+                    int(prefix[11:13]), int(prefix[14:16]),
+                    int(prefix[17:19]), 0, 0, -1)))
+            yield cached_epoch, level, source, line[20:]
+
+    @staticmethod
+    def convert_file(src_file_name, dst_file_name, src_format=None,
+                     dst_format=None):
+        """
+        Convert a log file between text lines and structured records.
+
+        :param str src_file_name: Full path to the log file to read.
+        :param str dst_file_name: Full path to the log file to write.
+        :param str src_format:    Record format of the source, None for text.
+        :param str dst_format:    Record format of the destination, None for
+                                  text.
+
+        """
+        with open(src_file_name, 'rb') as src, \
+                open(dst_file_name, 'wb') as dst:
+            if src_format is None:
+                records = LogRecords.from_text(
+                    i.decode('utf-8', 'replace') for i in src)
+            else:
+                records = LogRecords.decode(src, src_format)
+            batch = []
+            for record in records:
+                batch.append(record)
+                if len(batch) >= 10000:
+                    dst.write(LogRecords._encode_batch(batch, dst_format))
+                    batch = []
+            dst.write(LogRecords._encode_batch(batch, dst_format))
+
+    @staticmethod
+    def _encode_batch(records, record_format):
+        """
+        Encode records as text lines or structured records.
+
+        :param list records:      Records to encode.
+        :param str record_format: Record format, None for text.
+        :rtype: bytes
+
+        """
+        if record_format is None:
+            return ''.join(
+                i + '\n' for i in LogRecords.to_text(records)).encode('utf-8')
+        return LogRecords.encode(records, record_format)
+
+
+class LogFileError(Exception):
+    """Error for log file handling."""
+
+
+class LogFileArgumentValueError(LogFileError):
+    """Error for invalid log file argument values."""
+
+    def __init__(self, arg_name, arg_value, valid_values):
+        """
+        Constructor function.
+
+        :param str arg_name:      Target argument name.
+        :param any arg_value:     Target argument value.
+        :param list valid_values: Valid values for the argument.
+
+        """
+        message = "Argument '{}' has invalid value '{}', must be one of {}!"
+        self._message = message.format(arg_name, arg_value, valid_values)
+
+    def __str__(self):
+        """
+        String representation function.
+        """
+        return self._message
@@ -10,12 +10,28 @@ This module contains settings.
 """
 
 import yaml
+import copy
+import ctypes
+import ctypes.util
+import contextlib
+import fcntl
+import functools
+import hashlib
+import io
+import marshal
 import os
 import re
+import select
+import threading
+import traceback
 from flask import render_template
 from shutil import copyfile
 
 
+class SettingsConflictError(Exception):
+    """The config file has changed since the settings were read."""
+
+
 class Settings:
     """Settings container."""
 
@@ -28,21 +44,51 @@ class Settings:
     __TEMPLATE_CONFIG_FILE_NAME = 'zipatoserver_template.conf'
     """(*str*) Template config file name."""
 
-    __PATH_WITH_SLASH_PARAMETERS = [
+    __PATH_WITH_SLASH_PARAMETERS = frozenset([
         'WEB_API_PATH', 'WEB_GUI_PATH', 'WAKEONLAN_PATH', 'PING_PATH',
-        'SSH_PATH']
-    """(*list*) Parameters in this list with always end with a slash."""
+        'SSH_PATH'])
+    """(*frozenset*) Parameters in this list with always end with a slash."""
+
+    __PATH_WITHOUT_SLASH_PARAMETERS = frozenset([
+        'MESSAGE_LOG', 'ERROR_LOG', 'SSH_KEY_FILE'])
+    """(*frozenset*) Parameters in this list will never end with a slash."""
 
-    __PATH_WITHOUT_SLASH_PARAMETERS = [
-        'MESSAGE_LOG', 'ERROR_LOG', 'SSH_KEY_FILE']
-    """(*list*) Parameters in this list will never end with a slash."""
+    __BOOLEANS = {'yes': True, 'true': True, 'no': False, 'false': False}
+    """(*dict*) Lower case strings that are formatted as booleans."""
+
+    __CONVERTERS = None
+    """(*dict*) Format function of each path parameter, see _format_value."""
+
+    __SNAPSHOT_FORMAT = ('settings', 3)
+    """(*tuple*) Module and version of the snapshot content."""
 
     __CONFIG_FILE = None
     """(*str*) Full path and name of config file."""
 
+    __TOP_LEVEL_PARAM = re.compile(r'\A(\S+):.*\Z')
+    """(*re.Pattern*) Matches a top level parameter line in YAML output."""
+
     __PROGRAM_PATH = None
     """(*str*) Path of the program."""
 
+    __CACHE = None
+    """(*dict*) Parsed config file, see _get_config."""
+
+    __APPLIED = {}
+    """(*dict*) Settings last set as class attributes."""
+
+    __APPLY_LOCK = threading.Lock()
+    """(*threading.Lock*) Lock held while settings are set."""
+
+    __CALLBACKS = {}
+    """(*dict*) Callbacks of each setting, key None for all settings."""
+
+    __WATCHER = None
+    """(*tuple*) Watcher thread and its stop event."""
+
+    __INOTIFY_MASK = 0x00000008 | 0x00000080
+    """(*int*) Inotify events to watch, IN_CLOSE_WRITE and IN_MOVED_TO."""
+
     @staticmethod
     def static_init():
         """
@@ -72,11 +118,63 @@ class Settings:
         Set system constants from YAML file.
 
         """
-        with open(Settings.__CONFIG_FILE, 'r') as f:
-            constants = yaml.load(f)
-        for constant, value in constants.items():
-            setattr(
-                Settings, constant, Settings._format_value(constant, value))
+        Settings._apply_settings(Settings._get_config()['settings'])
+
+    @staticmethod
+    def reload_settings():
+        """
+        Parse the config file again even if it has not changed.
+
+        """
+        Settings._apply_settings(Settings._get_config(force=True)['settings'])
+
+    @staticmethod
+    def add_settings_callback(callback, constant=None):
+        """
+        Call a function when a setting is changed.
+
+        :param function callback: Function called with the name and the new
+                                  value of the setting, None if the setting
+                                  was removed.
+        :param str constant:      Setting to call the function for. If None
+                                  the function is called for all settings.
+
+        """
+        Settings.__CALLBACKS.setdefault(constant, []).append(callback)
+
+    @staticmethod
+    def watch_settings(interval=1.0):
+        """
+        Start a thread that sets changed settings from the config file.
+
+        The config file directory is watched with inotify. If inotify is not
+        available the config file is checked every interval seconds. Each
+        process watches the config file itself.
+
+        :param float interval: Seconds between checks of the config file
+                               and of the stop event.
+
+        """
+        if Settings.__WATCHER is not None:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=Settings._watch, args=(interval, stop), daemon=True)
+        Settings.__WATCHER = (thread, stop)
+        thread.start()
+
+    @staticmethod
+    def stop_watching_settings():
+        """
+        Stop the thread started by watch_settings.
+
+        """
+        if Settings.__WATCHER is None:
+            return
+        thread, stop = Settings.__WATCHER
+        Settings.__WATCHER = None
+        stop.set()
+        thread.join()
 
     @staticmethod
     def render_settings_html():
@@ -84,26 +182,9 @@ class Settings:
         Render web GUI for handling settings.
 
         """
-        # Load constants from disk
-        with open(Settings.__CONFIG_FILE, 'r') as f:
-            constants = yaml.load(f)
-        for constant, value in constants.items():
-            constants[constant] = Settings._format_value(constant, value)
-        # Load comments from disk
-        comments = {}
-        file = open(Settings.__CONFIG_FILE, encoding='utf-8')
-        lines = file.readlines()
-        for i in range(len(lines)-1, -1, -1):
-            # Test/set more comments
-            if re.match('\A#.*', lines[i]):
-                comments[constant] = (
-                    lines[i][1:].strip() + ' ' + comments[constant])
-            for key in constants.keys():
-                # Test/set new constant
-                regex = "\A{}:.*".format(key)
-                if re.match(regex, lines[i]):
-                    constant = key
-                    comments[constant] = ''
+        config = Settings._get_config()
+        constants = dict(config['settings'])
+        comments = config['comment_texts']
         return render_template(
             'settings.html', constants=constants, comments=comments,
             save_settings_path=(Settings.WEB_API_PATH + 'save_settings'),
@@ -121,14 +202,7 @@ class Settings:
         :returns: If the value was deleted from the parameter.
 
         """
-        with open(Settings.__CONFIG_FILE, 'r') as f:
-            settings_json = yaml.load(f)
-        status = False
-        if len(settings_json[param]) > 1:
-            del settings_json[param][value]
-            status = True
-        Settings.write_settings_to_file(settings_json)
-        return status
+        return Settings.edit_settings_file([('delete', param, value)])[0]
 
     @staticmethod
     def add_param_value_to_file(param, value):
@@ -139,12 +213,58 @@ class Settings:
         :param str value: Value to add.
 
         """
-        with open(Settings.__CONFIG_FILE, 'r') as f:
-            settings_json = yaml.load(f)
-        blank_value = list(settings_json[param].values())[0]
-        blank_value = {key: '' for key, value in blank_value.items()}
-        settings_json[param][value] = blank_value
-        Settings.write_settings_to_file(settings_json)
+        Settings.edit_settings_file([('add', param, value)])
+
+    @staticmethod
+    def get_settings_version():
+        """
+        Get the version of the settings file.
+
+        :rtype: str
+        :return: SHA-1 of the settings file content.
+
+        """
+        return Settings._get_config()['hash'].hex()
+
+    @staticmethod
+    def edit_settings_file(operations, version=None):
+        """
+        Apply a batch of edits to the settings file.
+
+        The settings file is locked, all operations are applied to the
+        settings read from it and the file is written once.
+
+        Operations are tuples of an action, a parameter and a value:
+
+        * ('add', param, value): Add a value with blank fields to a
+          parameter.
+        * ('delete', param, value): Remove a value from a parameter, unless
+          it is the last value.
+        * ('set', param, value): Set a parameter to a value.
+
+        :param list operations: Operations to apply in order.
+        :param str version:     Version from get_settings_version the
+                                operations are based on. If None the
+                                operations are applied to the current
+                                settings.
+        :rtype: list
+        :return: If each operation changed the settings.
+        :raises SettingsConflictError: If the settings file is not at
+                                       version.
+
+        """
+        with Settings._lock_settings_file():
+            config = Settings._get_config()
+            if version is not None and version != config['hash'].hex():
+                raise SettingsConflictError(
+                    "Settings file has changed since version '{}'".format(
+                        version))
+            settings_json = copy.deepcopy(config['yaml'])
+            status = [Settings._edit_settings(settings_json, *operation)
+                      for operation in operations]
+            if any(status):
+                Settings._write_settings(settings_json)
+        return status
 
     @staticmethod
     def write_settings_to_file(settings_json):
@@ -158,51 +278,332 @@ class Settings:
             Comments are only supported on top level parameters.
 
         """
-        file_obj = open(Settings.__CONFIG_FILE, 'r', encoding="utf-8")
-        # Read YAML file comments from disk.
-        lines = file_obj.readlines()
-        file_obj.close()
-        # Get all comments
-        comment = []
-        param_comments = {}
-        for i in range(len(lines)):
-            if len(lines[i]) > 0 and lines[i][0] == '#':
-                comment.append(lines[i].strip())
-                if lines[i+1][0] != '#':
-                    param = re.match('(.+?):.*', lines[i+1]).group(1)
-                    param_comments[param] = comment
-                    comment = []
-        # Set correct type of parameters
-        for param, value in settings_json.items():
-            settings_json[param] = Settings._format_value(param, value)
+        with Settings._lock_settings_file():
+            Settings._write_settings(settings_json)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _lock_settings_file():
+        """
+        Hold an exclusive lock on the settings file.
+
+        The lock is taken on a separate lock file, since the settings file is
+        replaced when it is written.
+
+        """
+        fd = os.open(
+            Settings.__CONFIG_FILE + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _edit_settings(settings_json, action, param, value):
+        """
+        Apply an edit operation to settings.
+
+        :param dict settings_json: Settings to edit.
+        :param str action:         'add', 'delete' or 'set'.
+        :param str param:          Parameter to edit.
+        :param value:              Value to add, delete or set.
+        :rtype: bool
+        :return: If the settings were changed.
+
+        """
+        if action == 'add':
+            blank_value = list(settings_json[param].values())[0]
+            blank_value = {key: '' for key, value in blank_value.items()}
+            settings_json[param][value] = blank_value
+            return True
+        elif action == 'delete':
+            if len(settings_json[param]) > 1:
+                del settings_json[param][value]
+                return True
+            return False
+        elif action == 'set':
+            changed = settings_json.get(param) != value
+            settings_json[param] = value
+            return changed
+        raise ValueError("Invalid settings edit action '{}'".format(action))
+
+    @staticmethod
+    def _write_settings(settings_json):
+        """
+        Write settings to file, the settings file must be locked.
+
+        :param dict settings_json: Settings that should be written to file.
+
+        """
+        # Get comments of the YAML file on disk
+        param_comments = dict(Settings._get_config()['comments'])
+        # Set correct type of top level parameters, nested parameters are
+        # written as they are
+        settings_json = {
+            param: value if isinstance(value, (dict, list))
+            else Settings._format_value(param, value)
+            for param, value in settings_json.items()}
         # Create YAML with comments
         settings_yaml = yaml.dump(settings_json,
                                   default_flow_style=False,
                                   indent=4)
-        settings_list = settings_yaml.split('\n')
-        i = 0
-        while i < len(settings_list):
-            top_level_param = re.match('\A(\S+):.*\Z', settings_list[i])
+        settings_list = []
+        for line in settings_yaml.split('\n'):
+            top_level_param = Settings.__TOP_LEVEL_PARAM.match(line)
             # Top level parameter found
             if top_level_param is not None:
-                param = top_level_param.group(1)
-                settings_list.insert(i, '')  # Add newline
-                i += 1
-                for test_param, comments in param_comments.items():
-                    if param == test_param:
-                        # Insert parameter comment
-                        for comment in comments:
-                            settings_list.insert(i, comment)
-                            i += 1
-                        del param_comments[param]
-                        break
-            i += 1
+                settings_list.append('')  # Add newline
+                # Add parameter comment
+                settings_list.extend(
+                    param_comments.pop(top_level_param.group(1), []))
+            settings_list.append(line)
         settings_yaml = '\n'.join(settings_list)[1:]
         #  Write YAML to file
         with open(Settings.__CONFIG_FILE+'~', 'w') as file_obj:
-            file_obj.writelines(settings_yaml)
+            file_obj.write(settings_yaml)
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
         os.rename(Settings.__CONFIG_FILE+'~', Settings.__CONFIG_FILE)
 
+    @staticmethod
+    def _get_config(force=False):
+        """
+        Get the parsed config file.
+
+        The config file is only read again when its modification time, size
+        or inode has changed, and only parsed again when its content has
+        changed, since it was last parsed. A config file that has been parsed
+        before, by any process, is loaded from its snapshot file.
+
+        :param bool force: Parse the config file even if it has not changed.
+        :rtype: dict
+        :return: Config file stat ("version"), SHA-1 of its content ("hash"),
+                 config file parsed as YAML ("yaml"), formatted settings
+                 ("settings"), lines ("lines"), comment lines of each
+                 setting ("comments") and comment text of each setting
+                 ("comment_texts").
+
+        """
+        stat = os.stat(Settings.__CONFIG_FILE)
+        version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        config = Settings.__CACHE
+        if not force and config is not None and config['version'] == version:
+            return config
+        with open(Settings.__CONFIG_FILE, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).digest()
+        if not force and config is not None and config['hash'] == digest:
+            # Only the file stat has changed
+            config = dict(config, version=version)
+        else:
+            config = None if force else Settings._read_snapshot(digest)
+            if config is None:
+                config = Settings._parse_config(data, digest)
+                Settings._write_snapshot(config)
+            config['version'] = version
+        Settings.__CACHE = config
+        return config
+
+    @staticmethod
+    def _parse_config(data, digest):
+        """
+        Parse the config file.
+
+        :param bytes data:   Content of the config file.
+        :param bytes digest: SHA-1 of the content.
+        :rtype: dict
+        :return: Parsed config file, see _get_config.
+
+        """
+        text = data.decode('utf-8')
+        lines = io.StringIO(text, newline=None).readlines()
+        constants = yaml.load(''.join(lines), Loader=yaml.FullLoader)
+        settings = Settings._format_settings(constants)
+        comments = Settings._get_comments(lines, settings)
+        comment_texts = {
+            constant: ''.join(i[1:].strip() + ' ' for i in comment)
+            for constant, comment in comments.items()}
+        return {'hash': digest, 'yaml': constants, 'settings': settings,
+                'lines': lines, 'comments': comments,
+                'comment_texts': comment_texts}
+
+    @staticmethod
+    def _get_snapshot_file():
+        """
+        Get the snapshot file of the config file.
+
+        :rtype: str
+        :return: Full path and name of the snapshot file.
+
+        """
+        return os.path.join(
+            os.path.dirname(Settings.__CONFIG_FILE),
+            '.{}.snapshot'.format(os.path.basename(Settings.__CONFIG_FILE)))
+
+    @staticmethod
+    def _read_snapshot(digest):
+        """
+        Read the snapshot of a parsed config file.
+
+        :param bytes digest: SHA-1 of the config file content.
+        :rtype: dict or None
+        :return: Snapshot, or None if there is no snapshot of the content.
+
+        """
+        try:
+            with open(Settings._get_snapshot_file(), 'rb') as file_obj:
+                snapshot = marshal.load(file_obj)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if (not isinstance(snapshot, dict) or
+                snapshot.get('format') != Settings.__SNAPSHOT_FORMAT or
+                snapshot.get('hash') != digest):
+            return None
+        return snapshot
+
+    @staticmethod
+    def _write_snapshot(snapshot):
+        """
+        Write the snapshot of a parsed config file.
+
+        The snapshot is not written if it contains values marshal does not
+        support or if the config directory is not writable.
+
+        :param dict snapshot: Snapshot, must contain the SHA-1 of the config
+                              file content.
+
+        """
+        snapshot_file = Settings._get_snapshot_file()
+        temp_file = '{}~{}'.format(snapshot_file, os.getpid())
+        try:
+            data = marshal.dumps(
+                dict(snapshot, format=Settings.__SNAPSHOT_FORMAT))
+            with open(temp_file, 'wb') as file_obj:
+                file_obj.write(data)
+            os.rename(temp_file, snapshot_file)
+        except ValueError:
+            pass
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temp_file)
+
+    @staticmethod
+    def _apply_settings(settings):
+        """
+        Set settings as class attributes.
+
+        All values are set under a lock and callbacks are then called for the
+        settings that have changed. Settings that are no longer in the config
+        file are deleted and their callbacks are called with None.
+
+        :param dict settings: Formatted settings.
+
+        """
+        with Settings.__APPLY_LOCK:
+            if settings is Settings.__APPLIED:
+                return
+            applied = Settings.__APPLIED
+            changed = {
+                constant: value for constant, value in settings.items()
+                if constant not in applied or applied[constant] != value}
+            for constant, value in changed.items():
+                setattr(Settings, constant, value)
+            for constant in applied:
+                if constant not in settings:
+                    delattr(Settings, constant)
+                    changed[constant] = None
+            Settings.__APPLIED = settings
+        for constant, value in changed.items():
+            callbacks = (Settings.__CALLBACKS.get(constant, []) +
+                         Settings.__CALLBACKS.get(None, []))
+            for callback in callbacks:
+                callback(constant, value)
+
+    @staticmethod
+    def _watch(interval, stop):
+        """
+        Set changed settings from the config file until stopped.
+
+        :param float interval:        Seconds between checks.
+        :param threading.Event stop:  Event that stops the watcher.
+
+        """
+        fd = Settings._inotify(os.path.dirname(Settings.__CONFIG_FILE))
+        try:
+            while not stop.is_set():
+                if fd is not None:
+                    if not select.select([fd], [], [], interval)[0]:
+                        continue
+                    try:
+                        while os.read(fd, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif stop.wait(interval):
+                    break
+                try:
+                    Settings._apply_settings(
+                        Settings._get_config()['settings'])
+                except (OSError, yaml.YAMLError):
+                    pass  # The config file is being replaced or edited
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    @staticmethod
+    def _inotify(path):
+        """
+        Get an inotify file descriptor that watches a directory.
+
+        :param str path: Directory to watch.
+        :rtype: int or None
+        :return: Non-blocking file descriptor, or None if inotify is not
+                 available.
+
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        path = os.fsencode(path or '.')
+        if libc.inotify_add_watch(fd, path, Settings.__INOTIFY_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    @staticmethod
+    def _get_comments(lines, constants):
+        """
+        Get the comments of each setting.
+
+        The comment of a setting is all comment lines between the previous
+        top level setting and the setting.
+
+        :param list lines:      Lines of the config file.
+        :param dict constants:  Settings in the config file.
+        :rtype: dict
+        :return: Stripped comment lines of each setting.
+
+        """
+        names = {str(constant): constant for constant in constants.keys()}
+        comments = {}
+        comment = []
+        for line in lines:
+            if line.startswith('#'):
+                comment.append(line.strip())
+                continue
+            name = line.partition(':')[0]
+            if name in names:
+                comments[names[name]] = comment
+                comment = []
+        return comments
+
     @staticmethod
     def _format_path(path, slash=True):
         """
@@ -222,6 +623,23 @@ class Settings:
             return path[:-1]
         return path
 
+    @staticmethod
+    def _format_settings(settings):
+        """
+        Format all parameter values, including values in nested parameters.
+
+        :param dict settings: Settings to format.
+        :rtype: dict
+        :return: Formatted settings.
+
+        """
+        converters = Settings.__CONVERTERS
+        if converters is None:
+            converters = Settings._get_converters()
+        format_value = Settings._format_scalar
+        return {param: converters.get(param, format_value)(value)
+                for param, value in settings.items()}
+
     @staticmethod
     def _format_value(param, value):
         """
@@ -233,14 +651,67 @@ class Settings:
         :return: A parameter with the correct type.
 
         """
-        if param in Settings.__PATH_WITH_SLASH_PARAMETERS:
-            return Settings._format_path(value, True)
-        elif param in Settings.__PATH_WITHOUT_SLASH_PARAMETERS:
-            return Settings._format_path(value, False)
-        elif str(value).lower() == 'yes' or str(value).lower() == 'true':
-            return True
-        elif str(value).lower() == 'no' or str(value).lower() == 'false':
-            return False
+        converters = Settings.__CONVERTERS
+        if converters is None:
+            converters = Settings._get_converters()
+        return converters.get(param, Settings._format_scalar)(value)
+
+    @staticmethod
+    def _get_converters():
+        """
+        Create the format function of each path parameter.
+
+        :rtype: dict
+        :return: Format function of each path parameter.
+
+        """
+        converters = {}
+        for param in Settings.__PATH_WITH_SLASH_PARAMETERS:
+            converters[param] = functools.partial(
+                Settings._format_path, slash=True)
+        for param in Settings.__PATH_WITHOUT_SLASH_PARAMETERS:
+            converters[param] = functools.partial(
+                Settings._format_path, slash=False)
+        Settings.__CONVERTERS = converters
+        return converters
+
+    @staticmethod
+    def _format_scalar(value):
+        """
+        Format a value that is not a path.
+
+        Strings like "yes" and "false" are formatted as booleans and plain
+        integer strings as integers. Nested parameters and lists are formatted
+        recursively.
+
+        :param value: Value to format.
+        :rtype: str, bool, int, dict or list
+        :return: A value with the correct type.
+
+        """
+        value_type = type(value)
+        if value_type is str:
+            boolean = Settings.__BOOLEANS.get(value.lower())
+            if boolean is not None:
+                return boolean
+            if not value[-1:].isdigit():
+                return value
+            try:
+                number = int(value)
+            except ValueError:
+                return value
+            # Only plain integers, strings like "00" and "1_0" are kept
+            return number if str(number) == value else value
+        elif value_type is dict:
+            return Settings._format_settings(value)
+        elif value_type is list:
+            return [Settings._format_scalar(i) for i in value]
+        elif value_type is bool or value_type is int or value is None:
+            return value
+        else:
+            boolean = Settings.__BOOLEANS.get(str(value).lower())
+            if boolean is not None:
+                return boolean
         try:
             return int(value)
         except (TypeError, ValueError):
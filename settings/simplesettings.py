@@ -10,8 +10,17 @@ This module contains settings.
 """
 
 import yaml
+import contextlib
+import ctypes
+import ctypes.util
+import functools
+import hashlib
+import marshal
 import os
 import re
+import select
+import threading
+import traceback
 from shutil import copyfile
 
 
@@ -27,18 +36,48 @@ class Settings:
     __TEMPLATE_CONFIG_FILE_NAME = 'project_template.conf'
     """(*str*) Template config file name."""
 
-    __PATH_WITH_SLASH_PARAMETERS = []
-    """(*list*) Parameters in this list with always end with a slash."""
+    __PATH_WITH_SLASH_PARAMETERS = frozenset()
+    """(*frozenset*) Parameters in this list with always end with a slash."""
 
-    __PATH_WITHOUT_SLASH_PARAMETERS = []
-    """(*list*) Parameters in this list will never end with a slash."""
+    __PATH_WITHOUT_SLASH_PARAMETERS = frozenset()
+    """(*frozenset*) Parameters in this list will never end with a slash."""
+
+    __BOOLEANS = {'yes': True, 'true': True, 'no': False, 'false': False}
+    """(*dict*) Lower case strings that are formatted as booleans."""
+
+    __CONVERTERS = None
+    """(*dict*) Format function of each path parameter, see _format_value."""
+
+    __SNAPSHOT_FORMAT = ('simplesettings', 3)
+    """(*tuple*) Module and version of the snapshot content."""
 
     __CONFIG_FILE = None
     """(*str*) Full path and name of config file."""
 
+    __TOP_LEVEL_PARAM = re.compile(r'\A(\S+):.*\Z')
+    """(*re.Pattern*) Matches a top level parameter line in YAML output."""
+
     __PROGRAM_PATH = None
     """(*str*) Path of the program."""
 
+    __VERSION = (None, None)
+    """(*tuple*) Stat and SHA-1 of the config file when it was last read."""
+
+    __APPLIED = {}
+    """(*dict*) Settings last set as class attributes."""
+
+    __APPLY_LOCK = threading.Lock()
+    """(*threading.Lock*) Lock held while settings are set."""
+
+    __CALLBACKS = {}
+    """(*dict*) Callbacks of each setting, key None for all settings."""
+
+    __WATCHER = None
+    """(*tuple*) Watcher thread and its stop event."""
+
+    __INOTIFY_MASK = 0x00000008 | 0x00000080
+    """(*int*) Inotify events to watch, IN_CLOSE_WRITE and IN_MOVED_TO."""
+
     @staticmethod
     def static_init():
         """
@@ -68,11 +107,55 @@ class Settings:
         Set system constants from YAML file.
 
         """
-        with open(Settings.__CONFIG_FILE, 'r') as f:
-            constants = yaml.load(f, Loader=yaml.FullLoader)
-        for constant, value in constants.items():
-            setattr(
-                Settings, constant, Settings._format_value(constant, value))
+        Settings._apply_settings(Settings._read_settings(force=True))
+
+    @staticmethod
+    def add_settings_callback(callback, constant=None):
+        """
+        Call a function when a setting is changed.
+
+        :param function callback: Function called with the name and the new
+                                  value of the setting, None if the setting
+                                  was removed.
+        :param str constant:      Setting to call the function for. If None
+                                  the function is called for all settings.
+
+        """
+        Settings.__CALLBACKS.setdefault(constant, []).append(callback)
+
+    @staticmethod
+    def watch_settings(interval=1.0):
+        """
+        Start a thread that sets changed settings from the config file.
+
+        The config file directory is watched with inotify. If inotify is not
+        available the config file is checked every interval seconds. Each
+        process watches the config file itself.
+
+        :param float interval: Seconds between checks of the config file
+                               and of the stop event.
+
+        """
+        if Settings.__WATCHER is not None:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=Settings._watch, args=(interval, stop), daemon=True)
+        Settings.__WATCHER = (thread, stop)
+        thread.start()
+
+    @staticmethod
+    def stop_watching_settings():
+        """
+        Stop the thread started by watch_settings.
+
+        """
+        if Settings.__WATCHER is None:
+            return
+        thread, stop = Settings.__WATCHER
+        Settings.__WATCHER = None
+        stop.set()
+        thread.join()
 
     @staticmethod
     def write_settings_to_file(settings_json):
@@ -100,37 +183,218 @@ class Settings:
                     param = re.match('(.+?):.*', lines[i+1]).group(1)
                     param_comments[param] = comment
                     comment = []
-        # Set correct type of parameters
-        for param, value in settings_json.items():
-            settings_json[param] = Settings._format_value(param, value)
+        # Set correct type of top level parameters, nested parameters are
+        # written as they are
+        settings_json = {
+            param: value if isinstance(value, (dict, list))
+            else Settings._format_value(param, value)
+            for param, value in settings_json.items()}
         # Create YAML with comments
         settings_yaml = yaml.dump(settings_json,
                                   default_flow_style=False,
                                   indent=4)
-        settings_list = settings_yaml.split('\n')
-        i = 0
-        while i < len(settings_list):
-            top_level_param = re.match('\A(\S+):.*\Z', settings_list[i])
+        settings_list = []
+        for line in settings_yaml.split('\n'):
+            top_level_param = Settings.__TOP_LEVEL_PARAM.match(line)
             # Top level parameter found
             if top_level_param is not None:
-                param = top_level_param.group(1)
-                settings_list.insert(i, '')  # Add newline
-                i += 1
-                for test_param, comments in param_comments.items():
-                    if param == test_param:
-                        # Insert parameter comment
-                        for comment in comments:
-                            settings_list.insert(i, comment)
-                            i += 1
-                        del param_comments[param]
-                        break
-            i += 1
+                settings_list.append('')  # Add newline
+                # Add parameter comment
+                settings_list.extend(
+                    param_comments.pop(top_level_param.group(1), []))
+            settings_list.append(line)
         settings_yaml = '\n'.join(settings_list)[1:]
         #  Write YAML to file
         with open(Settings.__CONFIG_FILE+'~', 'w') as file_obj:
-            file_obj.writelines(settings_yaml)
+            file_obj.write(settings_yaml)
         os.rename(Settings.__CONFIG_FILE+'~', Settings.__CONFIG_FILE)
 
+    @staticmethod
+    def _read_settings(force=False):
+        """
+        Read formatted settings from the config file.
+
+        Settings are loaded from the snapshot file if the config file has
+        been read before, by any process.
+
+        :param bool force: Read the settings even if the config file has not
+                           changed since it was last read.
+        :rtype: dict or None
+        :return: Formatted settings, or None if the content of the config
+                 file has not changed.
+
+        """
+        stat = os.stat(Settings.__CONFIG_FILE)
+        version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if not force and version == Settings.__VERSION[0]:
+            return None
+        with open(Settings.__CONFIG_FILE, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).digest()
+        if not force and digest == Settings.__VERSION[1]:
+            # Only the file stat has changed
+            Settings.__VERSION = (version, digest)
+            return None
+        snapshot = Settings._read_snapshot(digest)
+        if snapshot is None:
+            constants = yaml.load(
+                data.decode('utf-8'), Loader=yaml.FullLoader)
+            snapshot = {
+                'hash': digest,
+                'settings': Settings._format_settings(constants)}
+            Settings._write_snapshot(snapshot)
+        Settings.__VERSION = (version, digest)
+        return snapshot['settings']
+
+    @staticmethod
+    def _get_snapshot_file():
+        """
+        Get the snapshot file of the config file.
+
+        :rtype: str
+        :return: Full path and name of the snapshot file.
+
+        """
+        return os.path.join(
+            os.path.dirname(Settings.__CONFIG_FILE),
+            '.{}.snapshot'.format(os.path.basename(Settings.__CONFIG_FILE)))
+
+    @staticmethod
+    def _read_snapshot(digest):
+        """
+        Read the snapshot of formatted settings.
+
+        :param bytes digest: SHA-1 of the config file content.
+        :rtype: dict or None
+        :return: Snapshot, or None if there is no snapshot of the content.
+
+        """
+        try:
+            with open(Settings._get_snapshot_file(), 'rb') as file_obj:
+                snapshot = marshal.load(file_obj)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if (not isinstance(snapshot, dict) or
+                snapshot.get('format') != Settings.__SNAPSHOT_FORMAT or
+                snapshot.get('hash') != digest):
+            return None
+        return snapshot
+
+    @staticmethod
+    def _write_snapshot(snapshot):
+        """
+        Write the snapshot of formatted settings.
+
+        The snapshot is not written if it contains values marshal does not
+        support or if the config directory is not writable.
+
+        :param dict snapshot: Snapshot, must contain the SHA-1 of the config
+                              file content.
+
+        """
+        snapshot_file = Settings._get_snapshot_file()
+        temp_file = '{}~{}'.format(snapshot_file, os.getpid())
+        try:
+            data = marshal.dumps(
+                dict(snapshot, format=Settings.__SNAPSHOT_FORMAT))
+            with open(temp_file, 'wb') as file_obj:
+                file_obj.write(data)
+            os.rename(temp_file, snapshot_file)
+        except ValueError:
+            pass
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temp_file)
+
+    @staticmethod
+    def _apply_settings(settings):
+        """
+        Set settings as class attributes.
+
+        All values are set under a lock and callbacks are then called for the
+        settings that have changed. Settings that are no longer in the config
+        file are deleted and their callbacks are called with None.
+
+        :param dict settings: Formatted settings, None if the config file has
+                              not changed.
+
+        """
+        with Settings.__APPLY_LOCK:
+            if settings is None or settings is Settings.__APPLIED:
+                return
+            applied = Settings.__APPLIED
+            changed = {
+                constant: value for constant, value in settings.items()
+                if constant not in applied or applied[constant] != value}
+            for constant, value in changed.items():
+                setattr(Settings, constant, value)
+            for constant in applied:
+                if constant not in settings:
+                    delattr(Settings, constant)
+                    changed[constant] = None
+            Settings.__APPLIED = settings
+        for constant, value in changed.items():
+            callbacks = (Settings.__CALLBACKS.get(constant, []) +
+                         Settings.__CALLBACKS.get(None, []))
+            for callback in callbacks:
+                callback(constant, value)
+
+    @staticmethod
+    def _watch(interval, stop):
+        """
+        Set changed settings from the config file until stopped.
+
+        :param float interval:        Seconds between checks.
+        :param threading.Event stop:  Event that stops the watcher.
+
+        """
+        fd = Settings._inotify(os.path.dirname(Settings.__CONFIG_FILE))
+        try:
+            while not stop.is_set():
+                if fd is not None:
+                    if not select.select([fd], [], [], interval)[0]:
+                        continue
+                    try:
+                        while os.read(fd, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif stop.wait(interval):
+                    break
+                try:
+                    Settings._apply_settings(Settings._read_settings())
+                except (OSError, yaml.YAMLError):
+                    pass  # The config file is being replaced or edited
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    @staticmethod
+    def _inotify(path):
+        """
+        Get an inotify file descriptor that watches a directory.
+
+        :param str path: Directory to watch.
+        :rtype: int or None
+        :return: Non-blocking file descriptor, or None if inotify is not
+                 available.
+
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        path = os.fsencode(path or '.')
+        if libc.inotify_add_watch(fd, path, Settings.__INOTIFY_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
+
     @staticmethod
     def _format_path(path, slash=True):
         """
@@ -150,6 +414,23 @@ class Settings:
             return path[:-1]
         return path
 
+    @staticmethod
+    def _format_settings(settings):
+        """
+        Format all parameter values, including values in nested parameters.
+
+        :param dict settings: Settings to format.
+        :rtype: dict
+        :return: Formatted settings.
+
+        """
+        converters = Settings.__CONVERTERS
+        if converters is None:
+            converters = Settings._get_converters()
+        format_value = Settings._format_scalar
+        return {param: converters.get(param, format_value)(value)
+                for param, value in settings.items()}
+
     @staticmethod
     def _format_value(param, value):
         """
@@ -161,14 +442,67 @@ class Settings:
         :return: A parameter with the correct type.
 
         """
-        if param in Settings.__PATH_WITH_SLASH_PARAMETERS:
-            return Settings._format_path(value, True)
-        elif param in Settings.__PATH_WITHOUT_SLASH_PARAMETERS:
-            return Settings._format_path(value, False)
-        elif str(value).lower() == 'yes' or str(value).lower() == 'true':
-            return True
-        elif str(value).lower() == 'no' or str(value).lower() == 'false':
-            return False
+        converters = Settings.__CONVERTERS
+        if converters is None:
+            converters = Settings._get_converters()
+        return converters.get(param, Settings._format_scalar)(value)
+
+    @staticmethod
+    def _get_converters():
+        """
+        Create the format function of each path parameter.
+
+        :rtype: dict
+        :return: Format function of each path parameter.
+
+        """
+        converters = {}
+        for param in Settings.__PATH_WITH_SLASH_PARAMETERS:
+            converters[param] = functools.partial(
+                Settings._format_path, slash=True)
+        for param in Settings.__PATH_WITHOUT_SLASH_PARAMETERS:
+            converters[param] = functools.partial(
+                Settings._format_path, slash=False)
+        Settings.__CONVERTERS = converters
+        return converters
+
+    @staticmethod
+    def _format_scalar(value):
+        """
+        Format a value that is not a path.
+
+        Strings like "yes" and "false" are formatted as booleans and plain
+        integer strings as integers. Nested parameters and lists are formatted
+        recursively.
+
+        :param value: Value to format.
+        :rtype: str, bool, int, dict or list
+        :return: A value with the correct type.
+
+        """
+        value_type = type(value)
+        if value_type is str:
+            boolean = Settings.__BOOLEANS.get(value.lower())
+            if boolean is not None:
+                return boolean
+            if not value[-1:].isdigit():
+                return value
+            try:
+                number = int(value)
+            except ValueError:
+                return value
+            # Only plain integers, strings like "00" and "1_0" are kept
+            return number if str(number) == value else value
+        elif value_type is dict:
+            return Settings._format_settings(value)
+        elif value_type is list:
+            return [Settings._format_scalar(i) for i in value]
+        elif value_type is bool or value_type is int or value is None:
+            return value
+        else:
+            boolean = Settings.__BOOLEANS.get(str(value).lower())
+            if boolean is not None:
+                return boolean
         try:
             return int(value)
         except (TypeError, ValueError):